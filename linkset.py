@@ -0,0 +1,146 @@
+import os
+import hashlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 链接去重用的紧凑指纹集合，main.py 使用
+# 每个链接规范化后只保存64位或128位的blake2b指纹，按顺序存放在NumPy数组中，用二分查找判断是否存在
+# 同一批链接中指纹相同时再比较原字符串，真正的哈希碰撞只会让两个链接都保留，不会误删
+# 与之前批次或上一次运行保存的指纹比较时没有原字符串：64位指纹在2000万条链接时误判概率约为1e-5，需要更低时使用128位
+
+default_bits = 64
+
+def fingerprint_dtype(bits):
+    if bits == 64:
+        return np.dtype('<u8')
+    if bits == 128:
+        return np.dtype([('hi', '<u8'), ('lo', '<u8')])
+    raise ValueError(f"Unsupported fingerprint width: {bits}")
+
+# 规范化链接：协议和主机名转为小写，去掉默认端口和首尾空白，路径、参数和片段保持原样
+# 片段不去掉：一些源用#后的内容区分同一地址的不同线路或播放参数
+def canonical_link(link):
+    link = link.strip()
+    scheme_end = link.find('://')
+    if scheme_end < 0:
+        return link
+    host_start = scheme_end + 3
+    # 主机部分到第一个 / ? # 为止，没有路径时片段或参数不算进主机名
+    host_end = len(link)
+    for delimiter in '/?#':
+        pos = link.find(delimiter, host_start)
+        if 0 <= pos < host_end:
+            host_end = pos
+    scheme = link[:scheme_end].lower()
+    host = link[host_start:host_end].lower()
+    if (scheme == 'http' and host.endswith(':80')) or (scheme == 'https' and host.endswith(':443')):
+        host = host[:host.rfind(':')]
+    return f'{scheme}://{host}{link[host_end:]}'
+
+class LinkSet:
+    def __init__(self, bits=default_bits):
+        self.bits = bits
+        self.collisions = 0
+        if np is None:
+            self.hashes = set()
+        else:
+            self.hashes = np.empty(0, dtype=fingerprint_dtype(bits))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def memory_bytes(self):
+        if np is None:
+            return len(self.hashes) * (self.bits // 8 + 48)
+        return self.hashes.nbytes
+
+    def fingerprints(self, canonical_links):
+        size = self.bits // 8
+        data = b''.join(hashlib.blake2b(link.encode('utf-8'), digest_size=size).digest() for link in canonical_links)
+        if np is None:
+            return [int.from_bytes(data[i:i + size], 'little') for i in range(0, len(data), size)]
+        return np.frombuffer(data, dtype=fingerprint_dtype(self.bits))
+
+    # 返回每个链接是否已在集合中
+    def contains(self, links):
+        fingerprints = self.fingerprints([canonical_link(link) for link in links])
+        if np is None:
+            return [fingerprint in self.hashes for fingerprint in fingerprints]
+        if not len(self.hashes):
+            return np.zeros(len(fingerprints), dtype=bool)
+        positions = np.searchsorted(self.hashes, fingerprints)
+        return self.hashes[np.minimum(positions, len(self.hashes) - 1)] == fingerprints
+
+    # 按顺序加入一批链接，返回每个链接是否为第一次出现（批内第一次且不在之前的集合中）
+    def add(self, links):
+        canonical = [canonical_link(link) for link in links]
+        fingerprints = self.fingerprints(canonical)
+        if np is None:
+            return self.add_fallback(canonical, fingerprints)
+
+        unique, first, inverse = np.unique(fingerprints, return_index=True, return_inverse=True)
+        keep = np.zeros(len(canonical), dtype=bool)
+        keep[first] = True
+
+        # 批内指纹重复的链接与第一次出现的链接比较原字符串，不同则是碰撞
+        collided = {}
+        for index in np.flatnonzero(~keep).tolist():
+            first_index = int(first[inverse[index]])
+            if canonical[index] == canonical[first_index]:
+                continue
+            seen = collided.setdefault(first_index, {canonical[first_index]})
+            if canonical[index] not in seen:
+                seen.add(canonical[index])
+                keep[index] = True
+                self.collisions += 1
+
+        # 已在之前批次中出现过的指纹
+        if len(self.hashes):
+            positions = np.searchsorted(self.hashes, unique)
+            known = self.hashes[np.minimum(positions, len(self.hashes) - 1)] == unique
+            keep[np.isin(inverse, np.flatnonzero(known))] = False
+            new = unique[~known]
+            self.hashes = np.insert(self.hashes, positions[~known], new)
+        else:
+            self.hashes = unique
+        return keep
+
+    def add_fallback(self, canonical, fingerprints):
+        keep = []
+        batch_links = {}
+        for link, fingerprint in zip(canonical, fingerprints):
+            if fingerprint not in self.hashes:
+                self.hashes.add(fingerprint)
+                batch_links[fingerprint] = {link}
+                keep.append(True)
+            elif fingerprint in batch_links and link not in batch_links[fingerprint]:
+                batch_links[fingerprint].add(link)
+                self.collisions += 1
+                keep.append(True)
+            else:
+                keep.append(False)
+        return keep
+
+    def save(self, filename):
+        if np is None:
+            return
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, self.hashes)
+        os.replace(tmp_filename, filename)
+
+    @classmethod
+    def load(cls, filename, bits=default_bits):
+        linkset = cls(bits)
+        if np is None or not os.path.exists(filename):
+            return linkset
+        try:
+            hashes = np.load(filename)
+        except (OSError, ValueError):
+            return linkset
+        if hashes.dtype == fingerprint_dtype(bits):
+            linkset.hashes = hashes
+        return linkset
@@ -1,9 +1,32 @@
 import csv
+import json
+import os
+import re
+import time
+import hashlib
+import base64
+import random
+import statistics
+import struct
+import socket
+import ipaddress
+import sqlite3
+import gzip
+import heapq
+import shutil
+import tempfile
 import asyncio
 import aiohttp
+from aiohttp.abc import AbstractResolver
+from collections import deque
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape, quoteattr
+from urllib.parse import urlsplit, urlunsplit, urljoin, parse_qsl
 from tqdm import tqdm
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import logging
+import argparse
+import profiler as run_profiler
 
 # CSV文件名和输出文件名
 csv_filename = 'live_streams.csv'
@@ -12,6 +35,111 @@ output_txt_filename = 'iptv4.txt'
 output_csv_filename = 'valid_streams.csv'
 log_filename = 'iptv4_error.log'
 template_filename = 'moban.txt'  # moban.txt文件名
+template_cache_filename = 'template_cache.json'  # 编译后的模板，文件内容变化时重新编译
+# 其他模板（例如面向不同用户的频道列表）共用同一次探测结果，格式为(模板文件, 输出文件名前缀)
+template_lineups = []
+source_stats_filename = 'source_stats.json'  # 每个源的历史有效率统计，供main.py调度使用
+source_stats_alpha = 0.5  # 有效率滑动平均的权重
+host_cache_filename = 'host_cache.json'  # 跨运行保存的DNS缓存和失效主机列表
+dns_default_ttl = 300  # 无法取得TTL时DNS结果的缓存时间（秒）
+dns_negative_ttl = 3600  # 解析失败的主机的缓存时间（秒）
+host_failure_threshold = 3  # 同一主机连接失败几次后不再探测其余链接
+dead_host_keep_seconds = 86400  # 失效主机记录的保留时间（秒）
+redirect_stable_runs = 2  # 302/303/307重定向连续几次运行指向同一地址后才缓存（301/308直接缓存）
+redirect_host_min_urls = 2  # 同一主机有几个链接都永久重定向到新主机的相同路径后，对该主机的其他链接也适用
+redirect_keep_seconds = 7 * 86400  # 超过这个时间没有更新的重定向记录被删除
+redirect_max_failures = 3  # 缓存的最终地址连续失败几次后删除记录
+link_index_filename = 'link_index.sqlite'  # 按(频道, 链接)索引的探测结果库，增量合并每次的结果，工作流中通过缓存保留
+link_index_export_filename = 'link_index.csv'  # 索引的确定性导出，按(频道, 链接)排序，只含很少变化的列，便于git差异最小
+link_index_keep_seconds = 7 * 86400  # 超过这个时间没有出现过的链接从索引中删除
+tier_concurrency = [100, 80]  # 央视频道、卫视频道两个层级的并发数，优先探测
+default_concurrency = 50  # 其余层级的并发数
+udpxy_pattern = re.compile(r'^(https?://[^/]+)/(?:udp|rtp)/\d{1,3}(?:\.\d{1,3}){3}:\d+', re.IGNORECASE)  # udpxy组播转发地址
+udpxy_relay_concurrency = 4  # 每个udpxy转发服务器同时探测的频道数
+udpxy_ts_packets = 7  # 每个频道读取的TS包数量（7个188字节的包，约一个UDP数据报）
+udpxy_read_timeout = 5  # 读取TS包的超时（秒），组播没有数据时转发服务器会一直不返回
+udpxy_check_timeout = 5  # 检查转发服务器是否在线的超时（秒）
+protocol_concurrency = {'rtsp': 20, 'rtmp': 20, 'udp': 10}  # 非HTTP直播源各协议的并发探测数
+protocol_max_bytes = {'rtsp': 16 * 1024, 'rtmp': 16 * 1024, 'udp': 2048}  # 各协议探测最多读取的字节数
+protocol_timeout = 5  # 非HTTP探测的总超时（秒），组播没有数据时只能等到超时
+token_publish_interval = 3600  # 两次发布之间的间隔（秒），在下一次发布前过期的链接不再发布
+token_reprobe_lead = 300  # 在已知过期时间之前多久重新探测（秒）
+token_schedule_filename = 'token_schedule.json'  # 已发布的带过期时间链接的重新探测计划，供本地持续运行使用，不提交
+token_expiry_params = ('expires', 'expire', 'expiry', 'exp', 'deadline', 'validto', 'txtime')  # 值为过期时间的参数
+token_secret_params = ('token', 'authid', 'key', 'sign', 'signature', 'secret', 'txsecret', 'wssecret', 'wstime', 'st', 'auth')  # 看不出过期时间的鉴权参数
+happy_eyeballs_delay = 0.25  # IPv6连接开始后等待多久再开始IPv4连接（RFC 8305）
+family_connect_timeout = 3  # 双栈探测中每个地址族的连接超时（秒）
+family_probe_concurrency = 200  # 双栈探测的并发连接数
+probe_timeout = 10  # HTTP探测的超时（秒）
+probe_connect_timeout = 3  # 探测中建立连接的超时（秒），短于HTTP和非HTTP探测的总超时，连接超时计入主机熔断
+prescreen_timeout = 3  # TCP预筛（--prescreen）的连接超时（秒）
+prescreen_concurrency = 500  # TCP预筛的并发连接数
+default_ports = {'http': 80, 'https': 443, 'rtsp': 554, 'rtmp': 1935}  # 链接中没有端口时按协议使用的端口，udp不做TCP预筛
+ipv6_output_prefix = 'iptv6'  # 双栈模式下IPv6列表的输出文件名前缀
+logo_dir = 'logos'  # 台标缓存目录，文件名为内容哈希；有意提交到仓库，输出文件中改写后的台标地址指向这里的文件
+logo_index_filename = os.path.join(logo_dir, 'index.json')  # 台标地址 → 缓存文件、ETag、Last-Modified
+# 输出文件中缓存台标的地址前缀（可用--logo-base-url修改）；不用jsDelivr的@master，它的分支缓存会让新文件几个小时内404
+logo_base_url = 'https://raw.githubusercontent.com/qjlxg/iptv4/master/logos/'
+logo_concurrency = 20  # 同时下载的台标数量
+logo_max_bytes = 1 << 20  # 单个台标最大字节数
+epg_sources_filename = 'epg_sources.json'  # main.py收集的EPG地址，按源优先级排列
+output_epg_filename = 'iptv4.xml.gz'  # 按最终频道列表裁剪合并后的EPG
+epg_public_url = 'https://raw.githubusercontent.com/qjlxg/iptv4/master/iptv4.xml.gz'  # 写入m3u文件头x-tvg-url的地址，同样不用jsDelivr
+epg_keep_past_hours = 12  # 保留已经开始多久以内的节目
+epg_keep_future_hours = 48  # 保留多久以内开始的节目
+epg_download_timeout = 120  # 下载单个EPG的超时（秒）
+liveness_top_n = 3  # 活跃性检查：每个频道检查排名前几的直播源
+liveness_max_wait = 10  # 两次获取播放列表之间最多等待的秒数
+liveness_max_bytes = 256 * 1024  # 播放列表最多读取的字节数
+checkpoint_filename = 'probe_checkpoint.jsonl'  # 探测结果的追加式检查点，运行中断后可用 --resume 继续
+checkpoint_batch = 500  # 攒够这么多条结果写入一次
+checkpoint_interval = 5  # 或者距离上次写入超过这么多秒
+checkpoint_window_seconds = 2 * 3600  # 只续用这么长时间内开始的检查点，覆盖一次每小时定时运行的间隔
+dead_filter_filename = 'dead_links.bloom'  # 最近失效链接的布隆过滤器，跨运行保存（工作流中通过缓存保留，不提交）
+dead_filter_bits = 1 << 19  # 每一代过滤器的位数（64KB），约可容纳5万条链接，误判率约1%
+dead_filter_hashes = 7  # 每条链接使用的哈希位置数
+dead_filter_generations = 4  # 保留的代数，过滤器只记住最近18~24小时内失效的链接
+dead_filter_generation_seconds = 6 * 3600  # 每一代的时长（秒）
+dead_filter_recheck_rate = 0.05  # 命中过滤器的链接仍按这个比例抽样复查，纠正误判和恢复的链接
+budget_finalize_share = 0.1  # 时间预算模式（--budget）下留给统计和生成文件的预算比例，其余用于探测
+budget_known_good = 0.9  # 上次可用的链接的先验可用概率
+budget_known_bad = 0.2  # 上次失败的链接的先验可用概率，之后每多失败一次减半
+budget_default_yield = 0.5  # 没有历史记录的源的先验可用概率
+budget_host_weight = 2  # 本次同一主机的探测结果相当于多少次先验：p = (先验 × 权重 + 成功数) / (权重 + 探测数)
+budget_candidate_window = 16  # 每个频道只在先验最高的这么多个候选中按本次主机结果重新比较，限制每次选取的计算量
+# 速度、连续失败次数和最后出现时间每次运行都会变化，只保存在库中，导出时只保留可用/失效状态
+link_index_fields = ['tvg-name', 'link', 'tvg-id', 'tvg-logo', 'group-title', 'available']  # 不含source：同一链接出现在多个源中时取决于源的顺序
+
+# 综合得分 = Σ 权重 × 指标，得分越小排名越靠前
+ranking_weights = {'speed': 1.0}
+txt_streams_per_channel = 10  # txt文件中每个tvg-name保留的直播源数量
+numpy_ranking_threshold = 5000  # 有效直播源多于这个数量时使用NumPy向量化排序
+
+# 多次采样模式（--samples N）：对每个频道排名靠前的直播源重复测量首字节时间，记录中位数、p90和抖动
+# 排序只用中位数：5次采样的p90接近最大值，抖动也不稳定，加入得分后相邻两次运行的排名反而更不稳定（tools/benchmark.py stability）
+# 只有一次测量的直播源用这次的耗时代替中位数和p90，抖动按耗时本身计
+sampled_ranking_weights = {'latency_median': 1.0}
+latency_sample_timeout = 5  # 每次采样的超时（秒），超时或失败的采样按这个值计入
+latency_drain_bytes = 64 * 1024  # 采样时最多读取的响应字节数，小的播放列表读完后连接可以复用
+ranking_history_filename = 'ranking_history.json'  # 上一次运行每个频道的排名，用于统计排名稳定性
+
+# 内容指纹（--fingerprint）：同一内容经不同CDN主机名或参数分发的m3u8直播源合并为一组，txt文件中每组只保留一个
+fingerprint_shortlist = 2 * txt_streams_per_channel  # 每个频道取排名前几的m3u8直播源计算指纹
+fingerprint_min_shared = 2  # 两个媒体播放列表至少有几个相同的分片文件名才认为是同一内容
+fingerprint_segment_bytes = 16 * 1024  # 最新分片读取的字节数，内容哈希相同也认为是同一内容
+txt_max_per_host = 3  # txt文件中每个频道同一主机最多保留的直播源数量，不够10个时再放宽
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import aiodns
+    dns_errors = (OSError, aiodns.error.DNSError)
+except ImportError:
+    aiodns = None
+    dns_errors = (OSError,)
 
 # 设置日志记录
 logging.basicConfig(filename=log_filename, level=logging.ERROR, format='%(asctime)s - %(message)s')
@@ -19,37 +147,1984 @@ logging.basicConfig(filename=log_filename, level=logging.ERROR, format='%(asctim
 # 创建一个全局的tqdm实例
 progress_bar = None
 
-# 读取模板文件中的顺序
-def read_template(template_filename):
-    order = []
-    with open(template_filename, 'r', encoding='utf-8') as templatefile:
-        for line in templatefile:
-            line = line.strip()
-            if line:
-                order.append(line)
-    return order
+# 性能分析器，只在 --profile 时创建，未启用时探测热路径上只有一次None判断
+profiler = None
+
+# 按模板顺序的group-title顺序
+group_order = [
+    "央视频道",
+    "卫视频道",
+    "影视频道",
+    "数字频道",
+    "少儿频道",
+    "地方频道",
+    "港·澳·台"
+]
+
+# 频道名归一化，用于别名匹配，例如 "CCTV-1 高清" 和 "cctv1" 都对应 "CCTV1"
+def normalize_channel_name(name):
+    name = re.sub(r'\(\d+p\)|\[.*?\]|高清|超清|标清', '', name)
+    name = re.sub(r'[\s\-_·]', '', name).upper()
+    return re.sub(r'HD$', '', name) or name
+
+# 根据频道名推断所属分组，模板中没有分组行时使用
+def infer_group(name):
+    if re.match(r'(CCTV|CETV|CGTN)', name, re.IGNORECASE):
+        return '央视频道'
+    if '卫视' in name:
+        return '卫视频道'
+    return ''
+
+# 将模板编译为 名称→排名、名称→分组 和 别名→名称 三张表，按文件哈希缓存编译结果
+# 模板中 "分组,#genre#" 格式的行为其后的频道指定分组
+def compile_template(template_filename, template_cache_filename):
+    with open(template_filename, 'rb') as templatefile:
+        content = templatefile.read()
+    digest = hashlib.sha1(content).hexdigest()
+
+    template_cache = {}
+    if os.path.exists(template_cache_filename):
+        try:
+            with open(template_cache_filename, 'r', encoding='utf-8') as f:
+                template_cache = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {template_cache_filename}: {str(e)}")
+    compiled = template_cache.get(template_filename)
+    if compiled and compiled['hash'] == digest:
+        return compiled
+
+    rank = {}
+    groups = {}
+    aliases = {}
+    current_group = None
+    for line in content.decode('utf-8').splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.endswith(',#genre#'):
+            current_group = line[:-len(',#genre#')]
+            continue
+        if line in rank:
+            continue
+        rank[line] = len(rank)
+        groups[line] = current_group if current_group is not None else infer_group(line)
+        aliases.setdefault(normalize_channel_name(line), line)
+
+    compiled = {'hash': digest, 'rank': rank, 'group': groups, 'aliases': aliases}
+    template_cache[template_filename] = compiled
+    with open(template_cache_filename, 'w', encoding='utf-8') as f:
+        json.dump(template_cache, f, ensure_ascii=False)
+    return compiled
+
+# 直播源的综合得分
+def composite_score(stream):
+    return sum(weight * float(stream.get(metric) or 0.0) for metric, weight in ranking_weights.items())
+
+# 向量化排序：按(模板排名, 综合得分)排序，返回排序后的下标数组和每个直播源在频道内的名次
+def rank_order(channel_ranks, metrics):
+    scores = np.zeros(len(channel_ranks))
+    for metric, weight in ranking_weights.items():
+        scores += weight * metrics[metric]
+    order = np.lexsort((scores, channel_ranks))
+    sorted_ranks = channel_ranks[order]
+    count = len(sorted_ranks)
+    starts = np.flatnonzero(np.r_[True, sorted_ranks[1:] != sorted_ranks[:-1]]) if count else np.zeros(0, dtype=np.intp)
+    positions = np.arange(count) - np.repeat(starts, np.diff(np.r_[starts, count]))
+    return order, positions
+
+# 按模板的整数排名和综合得分对有效直播源做一次排序，返回[(排名, 频道内名次, 直播源)]
+# 通过别名匹配的直播源改用模板中的名称，没有分组的直播源使用模板中的分组
+def rank_streams(valid_streams, template, use_numpy=None):
+    rank = template['rank']
+    groups = template['group']
+    aliases = template['aliases']
+    matched = []
+    channel_ranks = []
+    for stream in valid_streams:
+        tvg_name = stream['tvg-name']
+        if tvg_name not in rank:
+            tvg_name = aliases.get(normalize_channel_name(tvg_name))
+            if tvg_name is None:
+                continue
+        group_title = stream['group-title'] or groups.get(tvg_name, '')
+        if tvg_name != stream['tvg-name'] or group_title != stream['group-title']:
+            stream = dict(stream, **{'tvg-name': tvg_name, 'group-title': group_title})
+        matched.append(stream)
+        channel_ranks.append(rank[tvg_name])
+
+    if use_numpy is None:
+        use_numpy = np is not None and len(matched) >= numpy_ranking_threshold
+    if use_numpy:
+        metrics = {metric: np.fromiter((float(stream.get(metric) or 0.0) for stream in matched), dtype=np.float64, count=len(matched))
+                   for metric in ranking_weights}
+        channel_ranks = np.asarray(channel_ranks, dtype=np.int64)
+        order, positions = rank_order(channel_ranks, metrics)
+        return [(rank_value, position, matched[index])
+                for rank_value, position, index in zip(channel_ranks[order].tolist(), positions.tolist(), order.tolist())]
+
+    ranked = sorted(zip(channel_ranks, matched), key=lambda item: (item[0], composite_score(item[1])))
+    result = []
+    last_rank = None
+    position = 0
+    for rank_value, stream in ranked:
+        position = position + 1 if rank_value == last_rank else 0
+        last_rank = rank_value
+        result.append((rank_value, position, stream))
+    return result
+
+# 读取跨运行保存的DNS缓存和失效主机列表
+def load_host_cache(host_cache_filename):
+    if not os.path.exists(host_cache_filename):
+        return {'dns': {}, 'dead_hosts': {}, 'redirects': {}}
+    try:
+        with open(host_cache_filename, 'r', encoding='utf-8') as f:
+            host_cache = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.error(f"Error reading {host_cache_filename}: {str(e)}")
+        return {'dns': {}, 'dead_hosts': {}, 'redirects': {}}
+    host_cache.setdefault('dns', {})
+    host_cache.setdefault('dead_hosts', {})
+    host_cache.setdefault('redirects', {})
+    return host_cache
+
+def save_host_cache(host_cache_filename, resolver, breaker, redirects):
+    with open(host_cache_filename, 'w', encoding='utf-8') as f:
+        json.dump({'dns': resolver.export(), 'dead_hosts': breaker.export(), 'redirects': redirects.export()}, f, indent=1, sort_keys=True)
+
+def url_origin(url):
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'.lower()
+
+# 重定向链缓存：按链接记录最终地址，探测时直接请求最终地址，失败时回退到原链接
+# 301/308直接缓存，302等临时重定向在连续几次运行中指向同一地址后才缓存
+# 同一主机的多个链接都永久重定向到另一主机的相同路径时，记录主机规则，对该主机的其他链接也适用
+class RedirectCache:
+    def __init__(self, data=None):
+        data = data or {}
+        now = time.time()
+        self.urls = {link: entry for link, entry in data.get('urls', {}).items() if now - entry['updated'] < redirect_keep_seconds}
+        self.hosts = {origin: rule for origin, rule in data.get('hosts', {}).items() if now - rule['updated'] < redirect_keep_seconds}
+        self.used = 0
+        self.saved = 0
+        self.fallbacks = 0
+
+    # 返回(最终地址, 跳数)，没有可用的缓存时返回(None, 0)
+    def lookup(self, link):
+        entry = self.urls.get(link)
+        if entry is not None:
+            return (entry['target'], entry['hops']) if entry['stable'] else (None, 0)
+        rule = self.hosts.get(url_origin(link))
+        if rule is not None and len(rule['urls']) >= redirect_host_min_urls:
+            target = urlsplit(rule['target'])
+            return urlunsplit(urlsplit(link)._replace(scheme=target.scheme, netloc=target.netloc)), 1
+        return None, 0
+
+    def record(self, link, history, final_url):
+        statuses = [response.status for response in history]
+        if not statuses:
+            self.urls.pop(link, None)
+            return
+        target = str(final_url)
+        entry = self.urls.get(link)
+        permanent = all(status in (301, 308) for status in statuses)
+        runs = entry['runs'] + 1 if entry is not None and entry['target'] == target else 1
+        self.urls[link] = {'target': target, 'hops': len(statuses), 'runs': runs,
+                           'stable': permanent or runs >= redirect_stable_runs, 'updated': int(time.time())}
+
+        # 只换了协议或主机、路径和参数不变的永久重定向，记入主机规则
+        source = urlsplit(link)
+        destination = urlsplit(target)
+        if permanent and len(statuses) == 1 and (source.path, source.query) == (destination.path, destination.query):
+            origin = url_origin(link)
+            rule = self.hosts.get(origin)
+            if rule is None or rule['target'] != url_origin(target):
+                rule = self.hosts[origin] = {'target': url_origin(target), 'urls': []}
+            if link not in rule['urls'] and len(rule['urls']) < redirect_host_min_urls:
+                rule['urls'].append(link)
+            rule['updated'] = int(time.time())
+
+    # 返回lookup使用的缓存记录：链接自己的记录或主机规则
+    def entry_for(self, link):
+        entry = self.urls.get(link)
+        if entry is not None:
+            return entry, self.urls, link
+        origin = url_origin(link)
+        return self.hosts.get(origin), self.hosts, origin
+
+    # 缓存的地址可用，清零失败次数
+    def succeed(self, link):
+        entry, _, _ = self.entry_for(link)
+        if entry is not None:
+            entry['failures'] = 0
+
+    # 缓存的地址不可用时记一次失败，连续失败redirect_max_failures次才删除记录，
+    # 避免主机规则下某个链接自己失效就让整条规则作废
+    def invalidate(self, link):
+        self.fallbacks += 1
+        entry, table, key = self.entry_for(link)
+        if entry is None:
+            return
+        entry['failures'] = entry.get('failures', 0) + 1
+        if entry['failures'] >= redirect_max_failures:
+            table.pop(key, None)
+
+    def export(self):
+        return {'urls': self.urls, 'hosts': self.hosts}
+
+    def report(self):
+        stable = sum(1 for entry in self.urls.values() if entry['stable'])
+        print(f"重定向缓存：{len(self.urls)} 个链接（{stable} 个已稳定）、{len(self.hosts)} 条主机规则，"
+              f"本次直接请求最终地址 {self.used} 次，节省 {self.saved} 次往返，回退到原链接 {self.fallbacks} 次")
+
+# 探测请求的超时：总超时之外单独限制建立连接的时间，连接超时抛出aiohttp.ServerTimeoutError
+def probe_client_timeout(total):
+    return aiohttp.ClientTimeout(total=total, sock_connect=min(probe_connect_timeout, total))
+
+# 请求一个直播源：有缓存的最终地址时先直接请求，失败再请求原链接并记录重定向链
+# 两次请求共用一个超时，最终地址超时后不会再用完整的超时请求原链接
+async def open_stream(session, link, redirects=None, timeout=probe_timeout, **kwargs):
+    target, hops = redirects.lookup(link) if redirects is not None else (None, 0)
+    if target is not None:
+        deadline = time.monotonic() + timeout
+        try:
+            response = await session.get(target, timeout=probe_client_timeout(timeout), **kwargs)
+            if response.status < 400:
+                redirects.used += 1
+                redirects.saved += max(0, hops - len(response.history))
+                redirects.succeed(link)
+                return response
+            response.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Error requesting cached redirect {target} for {link}: {str(e)}")
+            redirects.invalidate(link)
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise
+        else:
+            redirects.invalidate(link)
+            timeout = max(deadline - time.monotonic(), 0.001)
+    response = await session.get(link, timeout=probe_client_timeout(timeout), **kwargs)
+    if redirects is not None:
+        redirects.record(link, response.history, response.url)
+    return response
+
+# 带持久化缓存的DNS解析器，遵守记录的TTL，解析失败的结果也缓存
+class CachingResolver(AbstractResolver):
+    def __init__(self, cache=None):
+        self.cache = dict(cache or {})
+        self.preferred_family = {}  # 双栈探测中先连通的地址族，解析结果中排在前面
+        self.hits = 0
+        self.misses = 0
+        self.aiodns_resolver = aiodns.DNSResolver() if aiodns is not None else None
+
+    async def lookup(self, host):
+        now = time.time()
+        entry = self.cache.get(host)
+        if entry and entry['expires'] > now:
+            self.hits += 1
+            return entry['addrs']
+
+        self.misses += 1
+        try:
+            if self.aiodns_resolver is not None:
+                result = await self.aiodns_resolver.getaddrinfo(host, type=socket.SOCK_STREAM)
+                addrs = []
+                ttl = None
+                for node in result.nodes:
+                    address = node.addr[0]
+                    if isinstance(address, bytes):
+                        address = address.decode()
+                    if [node.family, address] not in addrs:
+                        addrs.append([node.family, address])
+                    ttl = node.ttl if ttl is None else min(ttl, node.ttl)
+                ttl = ttl if ttl else dns_default_ttl
+            else:
+                infos = await asyncio.get_running_loop().getaddrinfo(host, 0, type=socket.SOCK_STREAM)
+                addrs = []
+                for family, _, _, _, address in infos:
+                    if [family, address[0]] not in addrs:
+                        addrs.append([family, address[0]])
+                ttl = dns_default_ttl
+        except dns_errors as e:
+            self.cache[host] = {'addrs': [], 'expires': now + dns_negative_ttl}
+            raise OSError(f"DNS lookup failed for {host}: {str(e)}")
+
+        self.cache[host] = {'addrs': addrs, 'expires': now + ttl}
+        return addrs
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        addrs = await self.lookup(host)
+        hosts = []
+        for addr_family, address in addrs:
+            if family in (socket.AF_UNSPEC, addr_family):
+                hosts.append({
+                    'hostname': host,
+                    'host': address,
+                    'port': port,
+                    'family': addr_family,
+                    'proto': 0,
+                    'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+                })
+        if not hosts:
+            raise OSError(f"DNS lookup failed for {host}: no address")
+        preferred = self.preferred_family.get(host)
+        if preferred is not None:
+            hosts.sort(key=lambda item: item['family'] != preferred)
+        return hosts
+
+    async def close(self):
+        if self.aiodns_resolver is not None:
+            await self.aiodns_resolver.close()
+
+    def export(self):
+        now = time.time()
+        return {host: entry for host, entry in self.cache.items() if entry['expires'] > now}
+
+# 主机熔断器：同一主机连续连接失败达到阈值后，其余链接不再打开连接直接判定失败
+# 上次运行中失效的主机本次只复查一次，复查失败即熔断
+class HostBreaker:
+    def __init__(self, dead_hosts=None):
+        now = time.time()
+        self.previous_dead = {host: ts for host, ts in (dead_hosts or {}).items() if now - ts < dead_host_keep_seconds}
+        self.failures = {}
+        self.dead = {}
+        self.rechecks = {}
+        self.avoided = 0
+        self.failure_cost = 0.0
+        self.failure_count = 0
+
+    def is_open(self, host):
+        return host in self.dead
+
+    # 上次失效的主机只放行一个复查探测，其余链接等待复查结果
+    async def admit(self, host):
+        if host in self.previous_dead and host not in self.dead:
+            recheck = self.rechecks.get(host)
+            if recheck is None:
+                self.rechecks[host] = asyncio.Event()
+                return True
+            await recheck.wait()
+        return not self.is_open(host)
+
+    def release(self, host):
+        recheck = self.rechecks.get(host)
+        if recheck is not None:
+            recheck.set()
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.previous_dead.pop(host, None)
+
+    def record_failure(self, host, cost):
+        self.failure_cost += cost
+        self.failure_count += 1
+        self.failures[host] = self.failures.get(host, 0) + 1
+        threshold = 1 if host in self.previous_dead else host_failure_threshold
+        if self.failures[host] >= threshold:
+            self.dead[host] = time.time()
+
+    def export(self):
+        dead_hosts = dict(self.previous_dead)
+        dead_hosts.update(self.dead)
+        return dead_hosts
+
+    def report(self):
+        mean_cost = self.failure_cost / self.failure_count if self.failure_count else 0.0
+        print(f"主机熔断：{len(self.dead)} 个主机失效，跳过 {self.avoided} 次探测，"
+              f"节省约 {self.avoided * mean_cost:.1f} 秒探测时间")
+
+# 返回udpxy转发地址的转发服务器（协议+主机+端口），不是udpxy地址时返回None
+def relay_of(link):
+    match = udpxy_pattern.match(link)
+    return match.group(1).lower() if match else None
+
+# udpxy转发服务器：每个服务器只检查一次是否在线，离线服务器的所有频道直接判定不可用
+# 在线服务器限制同时探测的频道数，每个频道只读取几个TS包
+class RelayMonitor:
+    def __init__(self):
+        self.state = {}  # 转发服务器 → True在线 / False离线
+        self.locks = {}
+        self.slots = {}
+        self.channels = {}  # 转发服务器 → 频道数
+        self.skipped = 0
+        self.no_data = 0
+
+    def slot(self, relay):
+        if relay not in self.slots:
+            self.slots[relay] = asyncio.Semaphore(udpxy_relay_concurrency)
+        return self.slots[relay]
+
+    # 先请求udpxy的状态页，任何HTTP响应都说明服务器在线；状态页超时再用当前频道试一次
+    async def is_up(self, session, relay, link):
+        self.channels[relay] = self.channels.get(relay, 0) + 1
+        lock = self.locks.setdefault(relay, asyncio.Lock())
+        async with lock:
+            if relay not in self.state:
+                self.state[relay] = False
+                for url in (f'{relay}/status', link):
+                    try:
+                        async with session.get(url, timeout=udpxy_check_timeout):
+                            self.state[relay] = True
+                            break
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        logging.error(f"Error checking relay {url}: {str(e)}")
+        return self.state[relay]
+
+    def report(self):
+        if not self.state:
+            return
+        down = [relay for relay, up in self.state.items() if not up]
+        print(f"udpxy转发：{len(self.state)} 个服务器（{len(down)} 个离线）承载 {sum(self.channels.values())} 个频道，"
+              f"离线服务器的 {self.skipped} 个频道未逐个探测，{self.no_data} 个频道没有TS数据")
+
+# 检查数据是否为连续的TS包（每188字节一个0x47同步字节），允许从包中间开始
+def is_ts_data(data):
+    for offset in range(min(188, len(data))):
+        if all(data[i] == 0x47 for i in range(offset, len(data), 188)):
+            return len(data) - offset >= 188
+    return False
+
+# 探测udpxy转发的频道：转发服务器离线时直接失败；否则在服务器的并发限制内读取几个TS包
+# speed为收到这些TS包的时间
+async def test_relay_channel(sem, session, stream, relays, relay):
+    global progress_bar
+    cost = 0.0
+    try:
+        if not await relays.is_up(session, relay, stream['link']):
+            relays.skipped += 1
+            raise ValueError(f"Relay {relay} is down, skipped")
+
+        async with relays.slot(relay), sem:
+            probe_start = time.perf_counter()
+            try:
+                async with session.get(stream['link'], timeout=udpxy_check_timeout) as response:
+                    response.raise_for_status()
+                    try:
+                        data = await asyncio.wait_for(response.content.readexactly(udpxy_ts_packets * 188), udpxy_read_timeout)
+                    except asyncio.IncompleteReadError as e:
+                        data = e.partial
+                    except asyncio.TimeoutError:
+                        data = b''
+                    if not is_ts_data(data):
+                        relays.no_data += 1
+                        raise ValueError(f"No TS data from {stream['link']}")
+                    stream['speed'] = time.perf_counter() - probe_start
+            finally:
+                cost = time.perf_counter() - probe_start
+
+        progress_bar.update(1)
+        return {'stream': stream, 'available': True, 'cost': cost}
+
+    except (aiohttp.ClientError, ValueError, asyncio.TimeoutError) as e:
+        logging.error(f"Error testing stream {stream['link']}: {str(e)}")
+        progress_bar.update(1)
+        return {'stream': stream, 'available': False, 'cost': cost}
+
+# 按字节预算读取的TCP连接，超过预算时判定失败
+class BudgetReader:
+    def __init__(self, reader, max_bytes):
+        self.reader = reader
+        self.remaining = max_bytes
+
+    def take(self, count):
+        self.remaining -= count
+        if self.remaining < 0:
+            raise ValueError("Response exceeds the probe byte budget")
+
+    async def readexactly(self, count):
+        self.take(count)
+        return await self.reader.readexactly(count)
+
+    async def readuntil(self, separator):
+        data = await self.reader.readuntil(separator)
+        self.take(len(data))
+        return data
+
+# 发送一个RTSP请求，返回(状态码, 响应头, 响应体)
+async def rtsp_request(reader, writer, method, url, cseq, headers=''):
+    writer.write(f'{method} {url} RTSP/1.0\r\nCSeq: {cseq}\r\nUser-Agent: iptv4\r\n{headers}\r\n'.encode())
+    await writer.drain()
+    status_line, *header_lines = (await reader.readuntil(b'\r\n\r\n')).decode('utf-8', errors='replace').split('\r\n')
+    parts = status_line.split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('RTSP/') or not parts[1].isdigit():
+        raise ValueError(f"Not an RTSP response: {status_line[:50]}")
+    response_headers = {}
+    for line in header_lines:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            response_headers[name.strip().lower()] = value.strip()
+    length = int(response_headers.get('content-length', 0) or 0)
+    body = await reader.readexactly(length) if length else b''
+    return int(parts[1]), response_headers, body
+
+# 连接超时，与拒绝连接一样计入主机熔断
+class ConnectTimeoutError(ConnectionError):
+    pass
+
+# 非HTTP探测建立TCP连接，单独限制连接时间
+async def open_probe_connection(host, port):
+    try:
+        return await asyncio.wait_for(asyncio.open_connection(host, port), probe_connect_timeout)
+    except asyncio.TimeoutError:
+        raise ConnectTimeoutError(f"Connection timeout to {host}:{port}") from None
+
+# RTSP：OPTIONS确认是RTSP服务器，DESCRIBE返回包含媒体描述（m=行）的SDP才认为频道存在
+async def probe_rtsp(link):
+    parts = urlsplit(link)
+    raw_reader, writer = await open_probe_connection(parts.hostname, parts.port or default_ports['rtsp'])
+    reader = BudgetReader(raw_reader, protocol_max_bytes['rtsp'])
+    try:
+        status, _, _ = await rtsp_request(reader, writer, 'OPTIONS', link, 1)
+        if status != 200:
+            raise ValueError(f"RTSP OPTIONS returned {status}")
+        status, _, body = await rtsp_request(reader, writer, 'DESCRIBE', link, 2, 'Accept: application/sdp\r\n')
+        if status != 200:
+            raise ValueError(f"RTSP DESCRIBE returned {status}")
+        if not re.search(rb'^m=', body, re.MULTILINE):
+            raise ValueError("RTSP DESCRIBE returned no media description")
+    finally:
+        writer.close()
+
+# AMF0编码：字符串、数字和对象，只用于RTMP connect命令
+def amf0_encode(value):
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        return b'\x02' + struct.pack('>H', len(data)) + data
+    if isinstance(value, (int, float)):
+        return b'\x00' + struct.pack('>d', value)
+    body = b''.join(struct.pack('>H', len(key)) + key.encode('utf-8') + amf0_encode(item) for key, item in value.items())
+    return b'\x03' + body + b'\x00\x00\x09'
+
+# 读取一条完整的RTMP消息，返回(消息类型, 内容)；state保存块大小和每个块流的上一个消息头
+async def read_rtmp_message(reader, state):
+    while True:
+        first = (await reader.readexactly(1))[0]
+        fmt, csid = first >> 6, first & 0x3f
+        if csid == 0:
+            csid = 64 + (await reader.readexactly(1))[0]
+        elif csid == 1:
+            low, high = await reader.readexactly(2)
+            csid = 64 + low + high * 256
+        header = state['headers'].setdefault(csid, {'length': 0, 'type': 0, 'payload': b''})
+        if fmt < 3:
+            fields = await reader.readexactly((11, 7, 3)[fmt])
+            if fmt < 2:
+                header['length'] = int.from_bytes(fields[3:6], 'big')
+                header['type'] = fields[6]
+            if fields[:3] == b'\xff\xff\xff':
+                await reader.readexactly(4)
+        size = min(state['chunk_size'], header['length'] - len(header['payload']))
+        header['payload'] += await reader.readexactly(size)
+        if len(header['payload']) >= header['length']:
+            payload, header['payload'] = header['payload'], b''
+            if header['type'] == 1:
+                state['chunk_size'] = int.from_bytes(payload[:4], 'big') & 0x7fffffff
+            return header['type'], payload
+
+# RTMP：完成握手（C0/C1 → S0/S1/S2 → C2）后发送connect命令，收到_result才认为应用存在
+async def probe_rtmp(link):
+    parts = urlsplit(link)
+    raw_reader, writer = await open_probe_connection(parts.hostname, parts.port or default_ports['rtmp'])
+    reader = BudgetReader(raw_reader, protocol_max_bytes['rtmp'])
+    try:
+        c1 = struct.pack('>II', 0, 0) + os.urandom(1528)
+        writer.write(b'\x03' + c1)
+        await writer.drain()
+        s0_s1 = await reader.readexactly(1 + 1536)
+        if s0_s1[0] != 3:
+            raise ValueError(f"Unsupported RTMP version {s0_s1[0]}")
+        await reader.readexactly(1536)  # S2
+        writer.write(s0_s1[1:])  # C2
+        app = parts.path.lstrip('/').split('/', 1)[0]
+        command = (amf0_encode('connect') + amf0_encode(1) +
+                   amf0_encode({'app': app, 'tcUrl': f'{parts.scheme}://{parts.netloc}/{app}', 'flashVer': 'LNX 9,0,124,2'}))
+        chunks = [command[i:i + 128] for i in range(0, len(command), 128)]
+        writer.write(b'\x03' + b'\x00\x00\x00' + len(command).to_bytes(3, 'big') + b'\x14' + b'\x00\x00\x00\x00' +
+                     b'\xc3'.join(chunks))
+        await writer.drain()
+        state = {'chunk_size': 128, 'headers': {}}
+        while True:
+            message_type, payload = await read_rtmp_message(reader, state)
+            if message_type == 20 and payload[:1] == b'\x02':
+                name = payload[3:3 + struct.unpack('>H', payload[1:3])[0]]
+                if name == b'_result':
+                    return
+                if name == b'_error':
+                    raise ValueError("RTMP connect rejected")
+    finally:
+        writer.close()
+
+class UdpReceiver(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.received = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        if not self.received.done():
+            self.received.set_result(data)
+
+# udp://@组播地址:端口：加入组播组，收到一个TS数据报（可以带12字节RTP头）才认为频道可用
+async def probe_udp(link):
+    parts = urlsplit(link)
+    host = parts.hostname or '0.0.0.0'
+    port = parts.port
+    if port is None:
+        raise ValueError(f"UDP link has no port: {link}")
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        if ipaddress.ip_address(host).is_multicast:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(host) + socket.inet_aton('0.0.0.0'))
+        transport, protocol = await asyncio.get_running_loop().create_datagram_endpoint(UdpReceiver, sock=sock)
+    except BaseException:
+        # 任何异常（包括取消）都关闭套接字，避免泄漏
+        sock.close()
+        raise
+    try:
+        data = (await protocol.received)[:protocol_max_bytes['udp']]
+    finally:
+        transport.close()
+    if not is_ts_data(data) and not is_ts_data(data[12:]):
+        raise ValueError(f"No TS data from {link}")
+
+# 非HTTP协议的探测函数，按链接协议选择
+protocol_probers = {'rtsp': probe_rtsp, 'rtmp': probe_rtmp, 'udp': probe_udp}
+
+# 非HTTP直播源的探测：每个协议有自己的并发限制，同时占用分层并发限制器的名额；speed为握手完成的时间
+class ProtocolMonitor:
+    def __init__(self):
+        self.slots = {}
+        self.counts = {}  # 协议 → [探测数, 可用数]
+
+    def prober(self, link):
+        return protocol_probers.get(link.split('://', 1)[0].lower())
+
+    def slot(self, scheme):
+        if scheme not in self.slots:
+            self.slots[scheme] = asyncio.Semaphore(protocol_concurrency[scheme])
+        return self.slots[scheme]
+
+    async def test(self, sem, stream, breaker=None, deadline=None):
+        global progress_bar
+        link = stream['link']
+        scheme = link.split('://', 1)[0].lower()
+        counts = self.counts.setdefault(scheme, [0, 0])
+        counts[0] += 1
+        host = stream_host(link)
+        cost = 0.0
+        try:
+            if breaker is not None and breaker.is_open(host):
+                breaker.avoided += 1
+                raise ValueError(f"Host {host} is marked dead, skipped")
+            async with self.slot(scheme), sem:
+                # 排队期间主机可能已被熔断
+                if breaker is not None and breaker.is_open(host):
+                    breaker.avoided += 1
+                    raise ValueError(f"Host {host} is marked dead, skipped")
+                probe_start = time.perf_counter()
+                try:
+                    timeout = protocol_timeout if deadline is None else max(min(protocol_timeout, deadline - probe_start), 0.001)
+                    await asyncio.wait_for(protocol_probers[scheme](link), timeout)
+                    stream['speed'] = time.perf_counter() - probe_start
+                finally:
+                    cost = time.perf_counter() - probe_start
+            if breaker is not None:
+                breaker.record_success(host)
+            counts[1] += 1
+            progress_bar.update(1)
+            return {'stream': stream, 'available': True, 'cost': cost}
+        except (OSError, ValueError, struct.error, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            if breaker is not None and isinstance(e, ConnectionError):
+                breaker.record_failure(host, cost)
+            logging.error(f"Error testing stream {link}: {str(e)}")
+            progress_bar.update(1)
+            return {'stream': stream, 'available': False, 'cost': cost}
+
+    def report(self):
+        if self.counts:
+            print('非HTTP直播源：' + '，'.join(f"{scheme} 探测 {total} 个可用 {ok} 个" for scheme, (total, ok) in sorted(self.counts.items())))
+
+# 把各种格式的时间戳统一为秒：13位毫秒时间戳除以1000，不在2001年到100年后之间的视为无效
+def normalize_timestamp(value):
+    if value > 1e11:
+        value /= 1000
+    if 1e9 <= value <= time.time() + 100 * 365 * 86400:
+        return value
+    return None
+
+# 从链接中识别鉴权参数和过期时间，返回(类型, 过期时间)；没有鉴权参数时返回None，看不出过期时间时过期时间为None
+def parse_token_expiry(link):
+    params = {key.lower(): value for key, value in parse_qsl(urlsplit(link).query, keep_blank_values=True)}
+    if not params:
+        return None
+    try:
+        # 阿里云/百度 A 型鉴权：auth_key=过期时间-随机数-uid-签名
+        if 'auth_key' in params:
+            return 'auth_key', normalize_timestamp(int(params['auth_key'].split('-')[0]))
+        # Akamai：hdnts=st=...~exp=...~acl=...~hmac=...
+        for key in ('hdnts', '__token__'):
+            match = re.search(r'exp=(\d+)', params.get(key, ''))
+            if match:
+                return key, normalize_timestamp(int(match.group(1)))
+        # 央视等：_upt=8位十六进制签名 + 10位过期时间
+        match = re.search(r'(\d{10})$', params.get('_upt', ''))
+        if match:
+            return '_upt', normalize_timestamp(int(match.group(1)))
+        for key in token_expiry_params:
+            value = params.get(key, '')
+            if not value:
+                continue
+            # 腾讯云txTime为十六进制
+            number = int(value, 16) if key == 'txtime' else int(value)
+            return key, normalize_timestamp(number)
+        # JWT：从载荷中读取exp
+        for key, value in params.items():
+            parts = value.split('.')
+            if len(parts) == 3 and parts[0].startswith('eyJ'):
+                payload = json.loads(base64.urlsafe_b64decode(parts[1] + '=' * (-len(parts[1]) % 4)))
+                if 'exp' in payload:
+                    return 'jwt', normalize_timestamp(float(payload['exp']))
+    except (ValueError, TypeError):
+        pass
+    for key in token_secret_params:
+        if key in params:
+            return key, None
+    return None
+
+# 探测前剔除在下一次发布前就会过期的链接，返回(待探测, 即将过期)
+def filter_expiring(streams, now=None):
+    now = now if now is not None else time.time()
+    to_probe = []
+    expiring = []
+    for stream in streams:
+        token = parse_token_expiry(stream.get('link', ''))
+        if token is not None and token[1] is not None and token[1] - now < token_publish_interval:
+            expiring.append(stream)
+        else:
+            to_probe.append(stream)
+    return to_probe, expiring
+
+# 统计上一次发布的txt文件中有多少链接在发布窗口内过期
+# 发布时间取自文件末尾“更新时间”分组中的时间戳（文件修改时间在CI中是检出时间）；该分组的占位链接和分组标题行不计入
+# 没有找到发布时间时只统计链接数
+def count_expired_published(output_txt_filename):
+    if not os.path.exists(output_txt_filename):
+        return 0, 0
+    links = []
+    published_at = None
+    group = None
+    with open(output_txt_filename, 'r', encoding='utf-8') as txtfile:
+        for line in txtfile:
+            name, _, link = line.strip().partition(',')
+            if link == '#genre#':
+                group = name
+                continue
+            if group == '更新时间':
+                try:
+                    published_at = datetime.strptime(name, '%Y-%m-%d %H:%M:%S').timestamp()
+                except ValueError:
+                    pass
+                continue
+            if '://' in link:
+                links.append(link)
+    expired = 0
+    if published_at is not None:
+        for link in links:
+            token = parse_token_expiry(link)
+            if token is not None and token[1] is not None and token[1] < published_at + token_publish_interval:
+                expired += 1
+    return len(links), expired
+
+# 为已发布的带过期时间的链接生成重新探测计划，持续运行时在过期前重新探测并替换
+def write_token_schedule(ranked_streams, token_schedule_filename, now=None):
+    now = now if now is not None else time.time()
+    schedule = []
+    for _, position, stream in ranked_streams:
+        if position >= txt_streams_per_channel:
+            continue
+        token = parse_token_expiry(stream['link'])
+        if token is not None and token[1] is not None:
+            schedule.append({'channel': stream['tvg-name'], 'link': stream['link'], 'kind': token[0],
+                             'expires': int(token[1]), 'reprobe_at': int(max(now, token[1] - token_reprobe_lead))})
+    schedule.sort(key=lambda item: (item['reprobe_at'], item['channel'], item['link']))
+    with open(token_schedule_filename, 'w', encoding='utf-8') as f:
+        json.dump(schedule, f, ensure_ascii=False, indent=1)
+    return schedule
+
+# 按时间衰减的布隆过滤器，记录最近失效的链接
+# 分代保存，每过一代时长丢弃最旧的一代，链接恢复后最多一天就会被自然遗忘
+class DeadLinkFilter:
+    magic = b'IPTVDLF1'
+    header = struct.Struct('<8sIIId')
+
+    def __init__(self, bits=dead_filter_bits, hashes=dead_filter_hashes, generations=dead_filter_generations, started=None):
+        self.bits = bits
+        self.hashes = hashes
+        self.generations = [bytearray(bits // 8) for _ in range(generations)]
+        self.started = started if started is not None else time.time()
+
+    @classmethod
+    def load(cls, filename):
+        if not os.path.exists(filename):
+            return cls()
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            magic, bits, hashes, generations, started = cls.header.unpack_from(data)
+            if magic != cls.magic or len(data) != cls.header.size + generations * bits // 8:
+                raise ValueError('bad dead link filter file')
+        except (OSError, ValueError, struct.error) as e:
+            logging.error(f"Error reading {filename}: {str(e)}")
+            return cls()
+        dead_filter = cls(bits, hashes, generations, started)
+        size = bits // 8
+        for i in range(generations):
+            offset = cls.header.size + i * size
+            dead_filter.generations[i] = bytearray(data[offset:offset + size])
+        return dead_filter
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.header.pack(self.magic, self.bits, self.hashes, len(self.generations), self.started))
+            for generation in self.generations:
+                f.write(generation)
+
+    def positions(self, link):
+        digest = hashlib.blake2b(link.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = struct.unpack('<QQ', digest)
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, link):
+        generation = self.generations[0]
+        for position in self.positions(link):
+            generation[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, link):
+        positions = self.positions(link)
+        for generation in self.generations:
+            if all(generation[position >> 3] & (1 << (position & 7)) for position in positions):
+                return True
+        return False
+
+    # 当前一代已满一代时长时轮换，丢弃最旧的一代
+    def rotate(self, now=None):
+        now = now if now is not None else time.time()
+        while now - self.started >= dead_filter_generation_seconds:
+            self.generations = [bytearray(self.bits // 8)] + self.generations[:-1]
+            self.started += dead_filter_generation_seconds
+            if now - self.started >= dead_filter_generation_seconds * len(self.generations):
+                self.started = now
+
+    def memory_bytes(self):
+        return sum(len(generation) for generation in self.generations)
+
+    def fill_ratio(self):
+        generation = self.generations[0]
+        return sum(bin(byte).count('1') for byte in generation) / self.bits
+
+# 在进入探测队列之前过滤最近失效过的链接，命中的链接只按比例抽样复查，抽样的链接排在最后探测
+def filter_known_dead(streams, dead_filter, recheck_rate=dead_filter_recheck_rate):
+    to_probe = []
+    rechecks = []
+    skipped = []
+    for stream in streams:
+        if stream.get('link', '') in dead_filter:
+            if random.random() < recheck_rate:
+                rechecks.append(stream)
+            else:
+                skipped.append(stream)
+        else:
+            to_probe.append(stream)
+    return to_probe + rechecks, rechecks, skipped
+
+# 依次尝试同一地址族的地址，返回连接耗时，全部失败时返回None
+async def connect_family(addresses, port, timeout=family_connect_timeout):
+    start = time.perf_counter()
+    for address in addresses:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        except (OSError, asyncio.TimeoutError):
+            continue
+        writer.close()
+        return time.perf_counter() - start
+    return None
+
+# Happy Eyeballs：先连接IPv6，IPv6失败或等待happy_eyeballs_delay后开始连接IPv4，先连通的地址族胜出
+# 两个地址族的连接都会完成，分别记录是否连通和连接耗时（从竞速开始计算）
+async def race_families(resolver, host, port):
+    try:
+        address = ipaddress.ip_address(host)
+        addrs = [[socket.AF_INET6 if address.version == 6 else socket.AF_INET, host]]
+    except ValueError:
+        try:
+            addrs = await resolver.lookup(host)
+        except OSError:
+            addrs = []
+    ipv6 = [address for family, address in addrs if family == socket.AF_INET6]
+    ipv4 = [address for family, address in addrs if family == socket.AF_INET]
+
+    start = time.perf_counter()
+    result = {'family': None, 'ipv4': None, 'ipv6': None}
+    ipv6_failed = asyncio.Event()
+
+    async def attempt(name, addresses):
+        if not addresses:
+            return
+        if name == 'ipv4' and ipv6:
+            try:
+                await asyncio.wait_for(ipv6_failed.wait(), happy_eyeballs_delay)
+            except asyncio.TimeoutError:
+                pass
+        if await connect_family(addresses, port) is not None:
+            result[name] = time.perf_counter() - start
+            if result['family'] is None:
+                result['family'] = name
+        elif name == 'ipv6':
+            ipv6_failed.set()
+
+    if not ipv6:
+        ipv6_failed.set()
+    await asyncio.gather(attempt('ipv6', ipv6), attempt('ipv4', ipv4))
+    return result
+
+# 对所有直播源的 主机:端口 做一次双栈竞速，记录每个端点可用的地址族，并让HTTP探测优先使用先连通的地址族
+# 返回 (主机名, 端口) → 竞速结果
+async def probe_host_families(resolver, streams):
+    sem = asyncio.Semaphore(family_probe_concurrency)
+    # 按 (主机名, 端口) 去重，端口按协议取默认值；udp等没有TCP端点的链接不参与竞速
+    endpoints = {stream_endpoint(stream.get('link', '')) for stream in streams}
+    endpoints.discard(None)
+    endpoints = list(endpoints)
+
+    async def race(endpoint):
+        async with sem:
+            return await race_families(resolver, *endpoint)
+
+    start = time.perf_counter()
+    races = await asyncio.gather(*[race(endpoint) for endpoint in endpoints])
+    families = dict(zip(endpoints, races))
+    for (hostname, _), result in zip(endpoints, races):
+        if result['family'] is not None:
+            resolver.preferred_family[hostname] = socket.AF_INET6 if result['family'] == 'ipv6' else socket.AF_INET
+    counts = {name: sum(1 for result in races if result[name] is not None) for name in ('ipv4', 'ipv6')}
+    winners = {name: sum(1 for result in races if result['family'] == name) for name in ('ipv4', 'ipv6')}
+    print(f"双栈探测：{len(races)} 个主机，IPv4可用 {counts['ipv4']} 个（先连通 {winners['ipv4']} 个），"
+          f"IPv6可用 {counts['ipv6']} 个（先连通 {winners['ipv6']} 个），用时 {time.perf_counter() - start:.1f} 秒")
+    return families
+
+# 双栈模式下直播源是否属于某个地址族的列表：参与竞速的按竞速结果；没有参与竞速的（如udp组播）
+# 主机是IP地址时按地址版本，否则两个列表都保留
+def in_family_lineup(stream, family):
+    if 'family' in stream:
+        return stream.get(f'{family}_latency') is not None
+    try:
+        hostname = urlsplit(stream['link']).hostname
+        return ipaddress.ip_address(hostname).version == (6 if family == 'ipv6' else 4)
+    except (ValueError, TypeError):
+        return True
+
+# 把竞速结果记到直播源上：先连通的地址族和两个地址族的连接耗时
+def record_families(streams, families):
+    for stream in streams:
+        family = families.get(stream_endpoint(stream.get('link', '')))
+        if family is not None:
+            stream['family'] = family['family']
+            stream['ipv4_latency'] = family['ipv4']
+            stream['ipv6_latency'] = family['ipv6']
+
+# 直播源链接的 (主机名, 端口)，无法解析或不是已知协议时返回None
+def stream_endpoint(link):
+    try:
+        parts = urlsplit(link)
+        if parts.scheme.lower() not in default_ports:
+            return None
+        port = parts.port or default_ports[parts.scheme.lower()]
+    except ValueError:
+        return None
+    if not parts.hostname:
+        return None
+    return parts.hostname, port
+
+# 对一个 主机:端口 只做TCP连接，返回 'ok'、'dns'（解析失败）、'refused'（连接被拒绝或不可达）或 'timeout'
+async def screen_endpoint(resolver, hostname, port):
+    try:
+        ipaddress.ip_address(hostname)
+        addresses = [hostname]
+    except ValueError:
+        try:
+            addresses = [address for _, address in await resolver.lookup(hostname)]
+        except OSError:
+            return 'dns'
+    if not addresses:
+        return 'dns'
+    reason = 'timeout'
+    for address in addresses:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port), prescreen_timeout)
+        except asyncio.TimeoutError:
+            continue
+        except OSError:
+            reason = 'refused'
+            continue
+        writer.close()
+        return 'ok'
+    return reason
+
+# TCP预筛：每个 主机:端口 只连接一次，连不上的主机上的直播源直接判定失败，不再占用HTTP探测名额
+# 双栈模式下已经对每个主机做过连接竞速，直接使用竞速结果
+async def prescreen_streams(resolver, streams, families=None):
+    endpoints = {}
+    for stream in streams:
+        endpoint = stream_endpoint(stream.get('link', ''))
+        if endpoint is not None:
+            endpoints.setdefault(endpoint, []).append(stream)
+
+    start = time.perf_counter()
+    if families is not None:
+        verdicts = ['ok' if families.get(endpoint, {}).get('family') else 'refused' for endpoint in endpoints]
+    else:
+        sem = asyncio.Semaphore(prescreen_concurrency)
+
+        async def screen(endpoint):
+            async with sem:
+                return await screen_endpoint(resolver, *endpoint)
+
+        verdicts = await asyncio.gather(*[screen(endpoint) for endpoint in endpoints])
+
+    unreachable = []
+    reasons = {'dns': 0, 'refused': 0, 'timeout': 0}
+    for members, verdict in zip(endpoints.values(), verdicts):
+        if verdict != 'ok':
+            reasons[verdict] += 1
+            unreachable += [(stream, verdict) for stream in members]
+    for stream, verdict in unreachable:
+        logging.error(f"Error testing stream {stream['link']}: endpoint unreachable in TCP prescreen ({verdict})")
+    screened = {id(stream) for stream, _ in unreachable}
+    survivors = [stream for stream in streams if id(stream) not in screened]
+    print(f"TCP预筛：{len(endpoints)} 个主机:端口中 {sum(reasons.values())} 个不可达（解析失败 {reasons['dns']}，"
+          f"连接失败 {reasons['refused']}，超时 {reasons['timeout']}），跳过 {len(unreachable)} 个直播源的HTTP探测，"
+          f"{len(survivors)} 个进入HTTP探测，用时 {time.perf_counter() - start:.1f} 秒")
+    return survivors, [{'stream': stream, 'available': False, 'cost': 0.0, 'screen': verdict} for stream, verdict in unreachable]
+
+# 直播源链接的主机（含端口），用于熔断统计
+def stream_host(link):
+    try:
+        return urlsplit(link).netloc.lower()
+    except ValueError:
+        return ''
 
 # 异步测试直播源链接可用性和速度
-async def test_stream_quality(sem, session, stream):
+async def test_stream_quality(sem, session, stream, breaker=None, redirects=None, deadline=None):
     global progress_bar
+    cost = 0.0
+    host = ''
+    if profiler is not None:
+        wait_start = time.perf_counter()
     try:
         if 'link' not in stream:
             raise ValueError("Stream data is missing 'link' information")
 
+        host = stream_host(stream['link'])
+        if breaker is not None and not await breaker.admit(host):
+            breaker.avoided += 1
+            raise ValueError(f"Host {host} is marked dead, skipped")
+
         async with sem:
-            start_time = datetime.now()
-            async with session.get(stream['link'], timeout=10) as response:
-                response.raise_for_status()  # 抛出异常如果响应状态码不是200
-                end_time = datetime.now()
-                stream['speed'] = (end_time - start_time).total_seconds()  # 计算响应速度
+            if breaker is not None and breaker.is_open(host):
+                breaker.avoided += 1
+                raise ValueError(f"Host {host} is marked dead, skipped")
+
+            probe_start = time.perf_counter()
+            if profiler is not None:
+                profiler.phase('probe wait', probe_start - wait_start)
+            try:
+                timeout = probe_timeout if deadline is None else max(min(probe_timeout, deadline - probe_start), 0.001)
+                async with await open_stream(session, stream['link'], redirects, timeout=timeout) as response:
+                    response.raise_for_status()  # 抛出异常如果响应状态码不是200
+                    stream['speed'] = time.perf_counter() - probe_start  # 计算响应速度，使用单调时钟
+            finally:
+                cost = time.perf_counter() - probe_start  # 探测耗时，失败的探测同样计入源的成本
+                if profiler is not None:
+                    profiler.phase('probe request', cost)
 
+            if breaker is not None:
+                breaker.record_success(host)
+                breaker.release(host)
             progress_bar.update(1)
-            return {'stream': stream, 'available': True}
+            return {'stream': stream, 'available': True, 'cost': cost}
 
     except (aiohttp.ClientError, ValueError, asyncio.TimeoutError) as e:
+        # 只有连接层面的错误（拒绝连接、连接被重置、DNS失败、连接超时）才计入主机熔断，
+        # 总超时（服务器连上了但响应慢）不计入
+        if breaker is not None:
+            if isinstance(e, (aiohttp.ClientOSError, aiohttp.ServerTimeoutError)):
+                breaker.record_failure(host, cost)
+            breaker.release(host)
         logging.error(f"Error testing stream {stream.get('link', 'unknown link')}: {str(e)}")
         progress_bar.update(1)
-        return {'stream': stream, 'available': False}
+        return {'stream': stream, 'available': False, 'cost': cost}
+
+# 测量一次首字节时间（收到响应头的时间），使用单调时钟
+async def measure_ttfb(sem, session, link):
+    async with sem:
+        start = time.perf_counter()
+        try:
+            async with session.get(link, timeout=latency_sample_timeout) as response:
+                ttfb = time.perf_counter() - start
+                if response.status >= 400:
+                    return None
+                # 读完较小的响应体，连接才能放回连接池供下一次采样复用
+                size = 0
+                async for chunk in response.content.iter_chunked(16 * 1024):
+                    size += len(chunk)
+                    if size >= latency_drain_bytes:
+                        break
+                return ttfb
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.error(f"Error sampling stream {link}: {str(e)}")
+            return None
+
+# 采样结果的中位数、p90（最近秩）和抖动（相邻两次采样差值绝对值的平均）
+def latency_stats(samples):
+    ordered = sorted(samples)
+    jitter = statistics.mean(abs(b - a) for a, b in zip(samples, samples[1:])) if len(samples) > 1 else ordered[0]
+    return {
+        'latency_median': statistics.median(ordered),
+        'latency_p90': ordered[max(0, -(-len(ordered) * 9 // 10) - 1)],
+        'latency_jitter': jitter,
+    }
+
+# 按主机轮流排列，一轮采样中同一主机的请求尽量分散
+def interleave_by_host(streams):
+    by_host = {}
+    for stream in streams:
+        by_host.setdefault(stream_host(stream['link']), []).append(stream)
+    queues = list(by_host.values())
+    ordered = []
+    for index in range(max((len(queue) for queue in queues), default=0)):
+        ordered += [queue[index] for queue in queues if index < len(queue)]
+    return ordered
+
+# 对每个频道排名前txt_streams_per_channel的直播源做多轮首字节时间采样
+# 每一轮所有候选并发采样一次，轮与轮之间串行，总耗时约为 轮数 × 单轮最慢的采样
+async def sample_latency(sem, session, results, template, samples):
+    available = [result['stream'] for result in results if result['available']]
+    by_link = {stream['link']: stream for stream in available}
+    shortlist = interleave_by_host([by_link[stream['link']] for _, position, stream in rank_streams(available, template)
+                                    if position < txt_streams_per_channel and 'content_group' not in stream
+                                    and stream['link'].startswith(('http://', 'https://'))])
+
+    start = time.perf_counter()
+    measured = {stream['link']: [] for stream in shortlist}
+    failed = 0
+    for _ in range(samples):
+        ttfbs = await asyncio.gather(*[measure_ttfb(sem, session, stream['link']) for stream in shortlist])
+        for stream, ttfb in zip(shortlist, ttfbs):
+            if ttfb is None:
+                failed += 1
+                ttfb = latency_sample_timeout
+            measured[stream['link']].append(ttfb)
+
+    for stream in available:
+        if stream['link'] in measured:
+            stream.update(latency_stats(measured[stream['link']]))
+        else:
+            speed = float(stream.get('speed') or 0.0)
+            stream.update({'latency_median': speed, 'latency_p90': speed, 'latency_jitter': speed})
+    print(f"延迟采样：{len(shortlist)} 个直播源 × {samples} 次，失败 {failed} 次，"
+          f"涉及 {len({stream_host(stream['link']) for stream in shortlist})} 个主机，用时 {time.perf_counter() - start:.1f} 秒")
+
+# 与上一次同一模式的运行比较每个频道的排名：首选直播源不变的比例和前N个直播源的重合度
+def report_ranking_stability(ranked_streams, mode, ranking_history_filename):
+    current = {}
+    for _, position, stream in ranked_streams:
+        if position < txt_streams_per_channel:
+            current.setdefault(stream['tvg-name'], []).append(stream['link'])
+
+    history = {}
+    if os.path.exists(ranking_history_filename):
+        try:
+            with open(ranking_history_filename, 'r', encoding='utf-8') as f:
+                history = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {ranking_history_filename}: {str(e)}")
+
+    previous = history.get(mode, {})
+    common = [channel for channel in current if channel in previous]
+    if common:
+        same_top = sum(1 for channel in common if current[channel][0] == previous[channel][0])
+        overlap = statistics.mean(len(set(current[channel]) & set(previous[channel])) / len(set(current[channel]) | set(previous[channel]))
+                                  for channel in common)
+        print(f"排名稳定性（{mode}）：{len(common)} 个频道中首选直播源不变 {same_top / len(common):.1%}，"
+              f"前{txt_streams_per_channel}个直播源平均重合度 {overlap:.1%}")
+    history[mode] = current
+    with open(ranking_history_filename, 'w', encoding='utf-8') as f:
+        json.dump(history, f, ensure_ascii=False, sort_keys=True)
+
+# 解析HLS播放列表，返回目标时长、媒体序号、分片列表和子播放列表
+def parse_hls_playlist(text):
+    info = {'target_duration': None, 'media_sequence': 0, 'segments': [], 'variants': [], 'endlist': False}
+    expect_variant = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-TARGETDURATION:'):
+            try:
+                info['target_duration'] = float(line.split(':', 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            try:
+                info['media_sequence'] = int(line.split(':', 1)[1])
+            except ValueError:
+                pass
+        elif line.startswith('#EXT-X-STREAM-INF'):
+            expect_variant = True
+        elif line.startswith('#EXT-X-ENDLIST'):
+            info['endlist'] = True
+        elif line and not line.startswith('#'):
+            if expect_variant:
+                info['variants'].append(line)
+                expect_variant = False
+            else:
+                info['segments'].append(line)
+    return info
+
+# 获取播放列表文本，主播放列表自动跟随到第一个子播放列表
+async def fetch_hls_playlist(sem, session, url):
+    for _ in range(2):
+        async with sem:
+            async with session.get(url, timeout=10) as response:
+                response.raise_for_status()
+                body = await response.content.read(liveness_max_bytes)
+                url = str(response.url)
+        info = parse_hls_playlist(body.decode('utf-8', errors='replace'))
+        if not info['variants']:
+            return url, info
+        url = urljoin(url, info['variants'][0])
+    return url, info
+
+# 间隔一个目标时长获取两次媒体播放列表，序号或分片列表有变化才认为是直播中的流
+# 等待期间不占用信号量，多个频道的等待时间相互重叠
+async def check_liveness(sem, session, stream):
+    try:
+        url, first = await fetch_hls_playlist(sem, session, stream['link'])
+        if first['endlist']:
+            return False
+        await asyncio.sleep(min(first['target_duration'] or liveness_max_wait, liveness_max_wait))
+        async with sem:
+            async with session.get(url, timeout=10) as response:
+                response.raise_for_status()
+                body = await response.content.read(liveness_max_bytes)
+        second = parse_hls_playlist(body.decode('utf-8', errors='replace'))
+        return second['media_sequence'] != first['media_sequence'] or second['segments'][-1:] != first['segments'][-1:]
+    except (aiohttp.ClientError, ValueError, asyncio.TimeoutError) as e:
+        logging.error(f"Error checking liveness of {stream['link']}: {str(e)}")
+        return False
+
+# 对每个频道排名靠前的m3u8直播源做活跃性检查，画面静止或循环播放的直播源标记为不可用
+async def verify_liveness(sem, session, results, template):
+    available = [result for result in results if result['available']]
+    by_link = {result['stream']['link']: result for result in available}
+    candidates = [stream for _, position, stream in rank_streams([result['stream'] for result in available], template)
+                  if position < liveness_top_n and '.m3u8' in stream['link'] and 'content_group' not in stream]
+
+    start = time.perf_counter()
+    checks = await asyncio.gather(*[check_liveness(sem, session, stream) for stream in candidates])
+    frozen = 0
+    for stream, live in zip(candidates, checks):
+        if not live:
+            by_link[stream['link']]['available'] = False
+            frozen += 1
+    print(f"活跃性检查：检查 {len(candidates)} 个直播源，{frozen} 个未在更新，增加耗时 {time.perf_counter() - start:.1f} 秒")
+
+# 计算一个m3u8直播源的内容指纹：媒体播放列表中的分片文件名（去掉路径和参数）和最新分片开头部分的哈希
+async def fingerprint_stream(sem, session, stream):
+    try:
+        url, info = await fetch_hls_playlist(sem, session, stream['link'])
+        names = {urlsplit(segment).path.rsplit('/', 1)[-1] for segment in info['segments']}
+        names.discard('')
+        digest = None
+        if info['segments']:
+            async with sem:
+                async with session.get(urljoin(url, info['segments'][-1]), timeout=10,
+                                       headers={'Range': f'bytes=0-{fingerprint_segment_bytes - 1}'}) as response:
+                    response.raise_for_status()
+                    digest = hashlib.sha1(await response.content.read(fingerprint_segment_bytes)).hexdigest()
+        return names, digest
+    except (aiohttp.ClientError, ValueError, asyncio.TimeoutError) as e:
+        logging.error(f"Error fingerprinting stream {stream['link']}: {str(e)}")
+        return None
+
+# 对每个频道排名靠前的m3u8直播源计算内容指纹，同一频道内分片文件名重合或分片哈希相同的直播源合并为一组
+# 组内排名最高的直播源作为代表，其余直播源记录content_group，之后的活跃性检查和延迟采样跳过它们
+async def fingerprint_streams(sem, session, results, template):
+    available = [result['stream'] for result in results if result['available']]
+    by_link = {stream['link']: stream for stream in available}
+    shortlist = [by_link[stream['link']] for _, position, stream in rank_streams(available, template)
+                 if position < fingerprint_shortlist and '.m3u8' in stream['link'] and relay_of(stream['link']) is None]
+
+    start = time.perf_counter()
+    fingerprints = await asyncio.gather(*[fingerprint_stream(sem, session, stream) for stream in shortlist])
+    by_channel = {}
+    for stream, fingerprint in zip(shortlist, fingerprints):
+        if fingerprint is not None:
+            by_channel.setdefault(stream['tvg-name'], []).append((stream, fingerprint))
+
+    duplicates = 0
+    for members in by_channel.values():
+        groups = []  # [(代表直播源, 分片文件名集合, 分片哈希集合)]，按排名顺序
+        for stream, (names, digest) in members:
+            for representative, group_names, group_digests in groups:
+                if len(names & group_names) >= fingerprint_min_shared or (digest is not None and digest in group_digests):
+                    stream['content_group'] = representative['link']
+                    group_names |= names
+                    group_digests.add(digest)
+                    duplicates += 1
+                    break
+            else:
+                groups.append((stream, set(names), {digest}))
+    print(f"内容指纹：{len(shortlist)} 个m3u8直播源中 {sum(1 for fingerprint in fingerprints if fingerprint is not None)} 个取得指纹，"
+          f"{duplicates} 个与同频道排名更高的直播源内容相同，节省 {duplicates} 个后续探测名额，用时 {time.perf_counter() - start:.1f} 秒")
+
+# 按内容和主机多样性重新排列每个频道的直播源：先选不同内容且同一主机不超过txt_max_per_host个的直播源，
+# 不够时放宽主机限制，最后才是内容重复的直播源；首选直播源不变，只调整频道内名次
+def diversify_ranking(ranked_streams, report=False):
+    result = []
+    stats = {'channels': 0, 'duplicates': 0, 'host_capped': 0, 'replaced': 0}
+    index = 0
+    while index < len(ranked_streams):
+        end = index
+        while end < len(ranked_streams) and ranked_streams[end][0] == ranked_streams[index][0]:
+            end += 1
+        channel = ranked_streams[index:end]
+        index = end
+
+        distinct, capped, duplicates = [], [], []
+        groups = set()
+        hosts = {}
+        for item in channel:
+            stream = item[2]
+            group = stream.get('content_group', stream['link'])
+            host = stream_host(stream['link'])
+            if group in groups:
+                duplicates.append(item)
+            elif hosts.get(host, 0) >= txt_max_per_host:
+                groups.add(group)
+                capped.append(item)
+            else:
+                groups.add(group)
+                hosts[host] = hosts.get(host, 0) + 1
+                distinct.append(item)
+        reordered = distinct + capped + duplicates
+        result += [(rank_value, position, stream) for position, (rank_value, _, stream) in enumerate(reordered)]
+
+        # 原来前txt_streams_per_channel个中被重复内容和超出主机限制的直播源占用的名额
+        before = {id(item[2]) for item in channel[:txt_streams_per_channel]}
+        after = {id(item[2]) for item in reordered[:txt_streams_per_channel]}
+        duplicate_slots = len(before & {id(item[2]) for item in duplicates})
+        capped_slots = len(before & {id(item[2]) for item in capped})
+        if duplicate_slots or capped_slots:
+            stats['channels'] += 1
+        stats['duplicates'] += duplicate_slots
+        stats['host_capped'] += capped_slots
+        stats['replaced'] += len(before - after)
+    if report:
+        print(f"多样性排序：{stats['channels']} 个频道的前{txt_streams_per_channel}个直播源中有 {stats['duplicates']} 个内容重复、"
+              f"{stats['host_capped']} 个超出每主机 {txt_max_per_host} 个的限制，{stats['replaced']} 个输出名额改给了其他内容或主机的直播源")
+    return result
+
+# 探测结果检查点：结果先缓存在内存中，按条数或时间批量追加写入并fsync，限制中断时丢失的结果数量
+class ProbeCheckpoint:
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.buffer = []
+        self.last_flush = time.monotonic()
+        self.records = self.load(filename) if resume else {}
+        if self.records:
+            self.file = open(filename, 'a', encoding='utf-8')
+        else:
+            self.file = open(filename, 'w', encoding='utf-8')
+            self.file.write(json.dumps({'started': time.time()}) + '\n')
+            self.sync()
+
+    # 读取检查点中的结果，检查点过旧或损坏时返回空
+    @staticmethod
+    def load(filename):
+        records = {}
+        if not os.path.exists(filename):
+            return records
+        with open(filename, 'r', encoding='utf-8') as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                return records
+            if time.time() - header.get('started', 0) > checkpoint_window_seconds:
+                return records
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # 中断时最后一行可能只写了一半
+                records[record['link']] = record
+        return records
+
+    def record(self, result):
+        stream = result['stream']
+        self.buffer.append(json.dumps({
+            'link': stream.get('link', ''),
+            'available': result['available'],
+            'speed': stream.get('speed'),
+            'cost': round(result['cost'], 4),
+        }, ensure_ascii=False))
+        if len(self.buffer) >= checkpoint_batch or time.monotonic() - self.last_flush >= checkpoint_interval:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.file.write('\n'.join(self.buffer) + '\n')
+            self.buffer = []
+            self.sync()
+        self.last_flush = time.monotonic()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # 探测期间定时写入，结果稀疏时缓冲区中的结果也不会等待太久
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(checkpoint_interval)
+            if time.monotonic() - self.last_flush >= checkpoint_interval:
+                self.flush()
+
+    # 从检查点中恢复已经探测过的直播源，返回(已有结果, 需要探测的直播源)
+    def split(self, streams):
+        results = []
+        pending = []
+        for stream in streams:
+            record = self.records.get(stream.get('link'))
+            if record is None:
+                pending.append(stream)
+                continue
+            if record['speed'] is not None:
+                stream['speed'] = record['speed']
+            results.append({'stream': stream, 'available': record['available'], 'cost': record['cost']})
+        return results, pending
+
+    def close(self, remove=False):
+        self.flush()
+        self.file.close()
+        if remove:
+            os.remove(self.filename)
+
+# deadline为时间预算的截止时间，探测的超时不会超过剩余的预算
+async def probe_with_checkpoint(sem, session, stream, breaker, checkpoint, relays=None, redirects=None, protocols=None, deadline=None):
+    relay = relay_of(stream.get('link', '')) if relays is not None else None
+    if protocols is not None and protocols.prober(stream.get('link', '')) is not None:
+        result = await protocols.test(sem, stream, breaker, deadline)
+    elif relay is not None:
+        result = await test_relay_channel(sem, session, stream, relays, relay)
+    else:
+        result = await test_stream_quality(sem, session, stream, breaker, redirects, deadline)
+    checkpoint.record(result)
+    return result
+
+# 分层并发限制器：高层级还有等待的探测时不放行低层级，每个层级有自己的并发上限
+class TierLimiter:
+    def __init__(self, limits):
+        self.limits = limits
+        self.active = 0
+        self.waiters = [deque() for _ in limits]
+
+    def slot(self, tier):
+        return TierSlot(self, tier)
+
+    async def acquire(self, tier):
+        if self.active < self.limits[tier] and not any(self.waiters[:tier + 1]):
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[tier].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            elif waiter in self.waiters[tier]:
+                self.waiters[tier].remove(waiter)
+            raise
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def wake(self):
+        for tier, waiters in enumerate(self.waiters):
+            while waiters and self.active < self.limits[tier]:
+                waiter = waiters.popleft()
+                # 等待者可能已被取消（时间预算到期时），跳过它
+                if waiter.done():
+                    continue
+                self.active += 1
+                waiter.set_result(None)
+            if waiters:
+                return
+
+class TierSlot:
+    def __init__(self, limiter, tier):
+        self.limiter = limiter
+        self.tier = tier
+
+    async def __aenter__(self):
+        await self.limiter.acquire(self.tier)
+
+    async def __aexit__(self, *exc_info):
+        self.limiter.release()
+
+# 直播源的探测优先级(层级, 模板排名)：层级按group_order中的分组顺序，不在模板中的直播源排在最后
+def stream_priority(stream, template):
+    tvg_name = stream.get('tvg-name', '')
+    if tvg_name not in template['rank']:
+        tvg_name = template['aliases'].get(normalize_channel_name(tvg_name))
+        if tvg_name is None:
+            return (len(group_order) + 1, 0)
+    group_title = stream.get('group-title') or template['group'].get(tvg_name, '')
+    tier = group_order.index(group_title) if group_title in group_order else len(group_order)
+    return (tier, template['rank'][tvg_name])
+
+# 按层级探测直播源，每当一个层级及其之前的层级全部完成时调用 on_tier_done(层级, 已有结果)
+# deferred中的直播源（已知失效过滤器的抽样复查）放在最后一个层级，所有其他直播源之后才探测
+async def probe_streams(session, streams, template, breaker, checkpoint, on_tier_done=None, relays=None, redirects=None, protocols=None,
+                        deferred=()):
+    tier_count = len(group_order) + 3
+    deferred_ids = {id(stream) for stream in deferred}
+    priorities = [(tier_count - 1, 0) if id(stream) in deferred_ids else stream_priority(stream, template) for stream in streams]
+    limiter = TierLimiter([tier_concurrency[tier] if tier < len(tier_concurrency) else default_concurrency
+                           for tier in range(tier_count)])
+    remaining = [0] * tier_count
+    for tier, _ in priorities:
+        remaining[tier] += 1
+    tier_sizes = list(remaining)
+    finished_tiers = [0]
+    done_results = []
+
+    async def probe(stream, tier):
+        result = await probe_with_checkpoint(limiter.slot(tier), session, stream, breaker, checkpoint, relays, redirects, protocols)
+        done_results.append(result)
+        remaining[tier] -= 1
+        while finished_tiers[0] < tier_count and remaining[finished_tiers[0]] == 0:
+            finished_tier = finished_tiers[0]
+            finished_tiers[0] += 1
+            if on_tier_done is not None and tier_sizes[finished_tier] and any(remaining[finished_tiers[0]:]):
+                on_tier_done(finished_tier, done_results)
+        return result
+
+    order = sorted(range(len(streams)), key=lambda index: priorities[index])
+    results = await asyncio.gather(*[probe(streams[index], priorities[index][0]) for index in order])
+    return results, limiter
+
+# 两级探测的各级数量，以及预筛节省的探测名额时间：连接超时的直播源按探测的连接超时计，其余按本次HTTP失败探测的平均耗时计
+def report_funnel(total, screened_results, probe_results):
+    failed_costs = [result['cost'] for result in probe_results if not result['available']]
+    mean_cost = statistics.mean(failed_costs) if failed_costs else 0.0
+    timeouts = sum(1 for result in screened_results if result['screen'] == 'timeout')
+    saved = timeouts * probe_connect_timeout + (len(screened_results) - timeouts) * mean_cost
+    available = sum(1 for result in probe_results if result['available'])
+    print(f"两级探测：{total} 个直播源 → TCP预筛通过 {total - len(screened_results)} 个 → HTTP探测可用 {available} 个；"
+          f"预筛约节省 {saved:.0f} 秒探测名额时间（{timeouts} 个连接超时的直播源按 {probe_connect_timeout} 秒计）")
+
+# 时间预算模式的先验：链接索引中每个链接上次是否可用和连续失败次数，以及每个源的历史有效率
+def load_probe_priors(link_index_filename, link_index_export_filename, source_stats_filename):
+    conn = open_link_index(link_index_filename, link_index_export_filename)
+    links = {link: (available, fail_count) for link, available, fail_count in conn.execute('SELECT link, available, fail_count FROM streams')}
+    conn.close()
+    source_yields = {}
+    if os.path.exists(source_stats_filename):
+        try:
+            with open(source_stats_filename, 'r', encoding='utf-8') as f:
+                source_yields = {source: stats.get('yield', budget_default_yield) for source, stats in json.load(f).items()}
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {source_stats_filename}: {str(e)}")
+    return links, source_yields
+
+# 覆盖优先的探测调度：每次从“已找到可用直播源最少、进行中的探测最少”的模板频道中取可用概率最高的链接
+# 可用概率由先验和本次同一主机的探测结果估计；先广度覆盖所有频道，再为每个频道补足txt文件需要的数量
+# 频道按 (是否不在模板中, 已找到数, 进行中数, 层级) 放在堆中，状态变化时压入新条目，旧条目按序号作废
+class BudgetScheduler:
+    def __init__(self, streams, template, priors):
+        links, source_yields = priors
+        self.channels = {}
+        for stream in streams:
+            tier, rank_value = stream_priority(stream, template)
+            in_template = tier <= len(group_order)
+            key = (tier, rank_value) if in_template else (tier, stream.get('tvg-name', ''))
+            channel = self.channels.setdefault(key, {'in_template': in_template, 'tier': tier, 'candidates': [],
+                                                     'found': 0, 'in_flight': 0, 'covered_at': None, 'seq': 0})
+            known = links.get(stream.get('link', ''))
+            if known is None:
+                prior = source_yields.get(stream.get('source') or '', budget_default_yield)
+            elif known[0]:
+                prior = budget_known_good
+            else:
+                prior = budget_known_bad * 0.5 ** max(known[1] - 1, 0)
+            channel['candidates'].append((stream, stream_host(stream.get('link', '')), prior))
+        self.hosts = {}  # 主机 → [成功数, 探测数]
+        self.host_in_flight = {}  # 主机 → 进行中的探测数
+        self.in_flight = {}
+        self.heap = []
+        self.seq = 0
+        for key, channel in self.channels.items():
+            channel['candidates'].sort(key=lambda candidate: -candidate[2])
+            self.push(key, channel)
+        self.start = time.perf_counter()
+
+    def push(self, key, channel):
+        self.seq += 1
+        channel['seq'] = self.seq
+        if channel['candidates']:
+            order = (not channel['in_template'], min(channel['found'], txt_streams_per_channel), channel['in_flight'], channel['tier'])
+            heapq.heappush(self.heap, (order, self.seq, key))
+
+    def probability(self, host, prior):
+        ok, tries = self.hosts.get(host, (0, 0))
+        return (prior * budget_host_weight + ok) / (budget_host_weight + tries)
+
+    # 候选的排序键：可用概率相同时（例如没有任何历史记录）优先没有探测过、没有进行中探测的主机，
+    # 不按CSV顺序把一个频道的名额都压在同一个不响应的主机上
+    def candidate_key(self, candidate):
+        _, host, prior = candidate
+        attempts = self.hosts.get(host, (0, 0))[1] + self.host_in_flight.get(host, 0)
+        return self.probability(host, prior), -attempts
+
+    # 取下一个要探测的直播源，全部取完时返回None
+    def next(self):
+        while self.heap:
+            _, seq, key = heapq.heappop(self.heap)
+            channel = self.channels[key]
+            if seq == channel['seq'] and channel['candidates']:
+                break
+        else:
+            return None
+        candidates = channel['candidates']
+        index = max(range(min(len(candidates), budget_candidate_window)), key=lambda i: self.candidate_key(candidates[i]))
+        stream, host, _ = candidates.pop(index)
+        channel['in_flight'] += 1
+        self.host_in_flight[host] = self.host_in_flight.get(host, 0) + 1
+        self.push(key, channel)
+        self.in_flight[id(stream)] = (key, host)
+        return stream
+
+    def done(self, stream, available):
+        key, host = self.in_flight.pop(id(stream))
+        channel = self.channels[key]
+        channel['in_flight'] -= 1
+        self.host_in_flight[host] -= 1
+        stats = self.hosts.setdefault(host, [0, 0])
+        stats[1] += 1
+        if available:
+            stats[0] += 1
+            channel['found'] += 1
+            if channel['covered_at'] is None:
+                channel['covered_at'] = time.perf_counter() - self.start
+        self.push(key, channel)
+
+    # 覆盖率报告：模板频道的覆盖数、按层级的覆盖、覆盖达到最终覆盖的50%/90%/100%的用时
+    def report(self, template, budget, probe_seconds, probed, cancelled):
+        template_channels = [channel for channel in self.channels.values() if channel['in_template']]
+        covered = sorted(channel['covered_at'] for channel in template_channels if channel['covered_at'] is not None)
+        unprobed = sum(len(channel['candidates']) for channel in self.channels.values())
+        print(f"时间预算：预算 {budget:.0f} 秒，探测用时 {probe_seconds:.1f} 秒，探测 {probed} 个直播源，"
+              f"截止时取消 {cancelled} 个进行中的探测，{unprobed} 个未探测")
+        print(f"  模板 {len(template['rank'])} 个频道中 {len(template_channels)} 个有候选直播源，覆盖 {len(covered)} 个"
+              f"（{len(covered) / len(template['rank']) if template['rank'] else 0.0:.1%}）")
+        tiers = {}
+        for channel in template_channels:
+            counts = tiers.setdefault(channel['tier'], [0, 0])
+            counts[0] += channel['covered_at'] is not None
+            counts[1] += 1
+        print('  ' + '，'.join(f"{group_order[tier] if tier < len(group_order) else '其他频道'} {counts[0]}/{counts[1]}"
+                               for tier, counts in sorted(tiers.items())))
+        if covered:
+            print('  覆盖达到最终覆盖的 ' + '、'.join(f"{share:.0%} 用时 {covered[max(0, int(-(-len(covered) * share // 1)) - 1)]:.1f} 秒"
+                                              for share in (0.5, 0.9, 1.0)))
+
+# 在时间预算的截止时间前运行一个可选阶段，超时则取消；返回(是否完成, 结果)，没有预算时直接运行
+async def within_budget(coro, deadline, name):
+    if deadline is None:
+        return True, await coro
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        coro.close()
+        print(f"时间预算已用完，跳过{name}")
+        return False, None
+    try:
+        return True, await asyncio.wait_for(coro, remaining)
+    except asyncio.TimeoutError:
+        print(f"时间预算已用完，{name}在 {remaining:.1f} 秒后取消")
+        return False, None
+
+# 时间预算模式的探测：固定数量的工作协程按BudgetScheduler的顺序取链接，到截止时间时取消进行中的探测
+# 被取消和未探测的直播源不计入结果，留在检查点外，下次可用 --resume 继续
+async def probe_streams_budget(session, streams, template, breaker, checkpoint, relays, redirects, protocols, priors, deadline, budget):
+    concurrency = tier_concurrency[0]
+    limiter = TierLimiter([concurrency])
+    scheduler = BudgetScheduler(streams, template, priors)
+    results = []
+
+    async def worker():
+        while True:
+            stream = scheduler.next()
+            if stream is None:
+                return
+            result = await probe_with_checkpoint(limiter.slot(0), session, stream, breaker, checkpoint, relays, redirects, protocols, deadline)
+            scheduler.done(stream, result['available'])
+            results.append(result)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    _, pending = await asyncio.wait(workers, timeout=max(0.0, deadline - time.perf_counter()))
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    cancelled = len(scheduler.in_flight)  # 被取消的探测没有调用done，仍留在in_flight中
+    scheduler.report(template, budget, time.perf_counter() - scheduler.start, len(results), cancelled)
+    return results, limiter
+
+# 台标地址去重，返回 台标地址 → 引用次数，按首次出现的顺序
+def build_logo_table(streams):
+    table = {}
+    for stream in streams:
+        logo = stream.get('tvg-logo', '')
+        if logo.startswith(('http://', 'https://')):
+            table[logo] = table.get(logo, 0) + 1
+    return table
+
+# 下载一个台标，已缓存的台标使用条件请求，内容按哈希命名，相同内容只保存一份
+async def fetch_logo(sem, session, url, entry, stats):
+    headers = {}
+    if entry and os.path.exists(os.path.join(logo_dir, entry['file'])):
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        async with sem:
+            stats['active'] += 1
+            stats['peak'] = max(stats['peak'], stats['active'])
+            try:
+                async with session.get(url, headers=headers, timeout=10) as response:
+                    if response.status == 304:
+                        stats['not_modified'] += 1
+                        return entry
+                    response.raise_for_status()
+                    content = await response.content.read(logo_max_bytes)
+                    content_type = response.headers.get('Content-Type', '')
+                    etag = response.headers.get('ETag')
+                    last_modified = response.headers.get('Last-Modified')
+            finally:
+                stats['active'] -= 1
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Error fetching logo {url}: {str(e)}")
+        stats['failed'] += 1
+        return entry
+
+    extension = os.path.splitext(urlsplit(url).path)[1].lower()
+    if extension not in ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg'):
+        extension = '.' + content_type.split('/')[-1].split(';')[0].strip() if content_type.startswith('image/') else '.png'
+    filename = hashlib.sha1(content).hexdigest()[:12] + extension
+    path = os.path.join(logo_dir, filename)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(content)
+    stats['fetched'] += 1
+    stats['bytes'] += len(content)
+    return {'file': filename, 'etag': etag, 'last_modified': last_modified}
+
+# 并发下载有效直播源用到的台标到本地缓存，返回 台标地址 → 缓存地址
+# 索引只保留本次用到的台标，不再被引用的文件删除，提交的目录不会一直增长
+async def prefetch_logos(streams, base_url=logo_base_url):
+    os.makedirs(logo_dir, exist_ok=True)
+    logo_index = {}
+    if os.path.exists(logo_index_filename):
+        try:
+            with open(logo_index_filename, 'r', encoding='utf-8') as f:
+                logo_index = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {logo_index_filename}: {str(e)}")
+
+    table = build_logo_table(streams)
+    stats = {'active': 0, 'peak': 0, 'fetched': 0, 'not_modified': 0, 'failed': 0, 'bytes': 0}
+    sem = asyncio.Semaphore(logo_concurrency)
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        entries = await asyncio.gather(*[fetch_logo(sem, session, url, logo_index.get(url), stats) for url in table])
+
+    logo_index = {url: entry for url, entry in zip(table, entries) if entry}
+    with open(logo_index_filename, 'w', encoding='utf-8') as f:
+        json.dump(logo_index, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+    files = {entry['file'] for entry in entries if entry}
+    for filename in os.listdir(logo_dir):
+        if filename not in files and filename != os.path.basename(logo_index_filename):
+            os.remove(os.path.join(logo_dir, filename))
+    print(f"台标：{len(table)} 个不同地址（{sum(table.values())} 次引用），{len(files)} 个不同文件，"
+          f"下载 {stats['fetched']} 个（{stats['bytes'] // 1024} KB），未修改 {stats['not_modified']} 个，失败 {stats['failed']} 个，"
+          f"最大并发 {stats['peak']}，用时 {time.perf_counter() - start:.1f} 秒")
+    return {url: base_url + entry['file'] for url, entry in zip(table, entries) if entry}
+
+# 将直播源的台标地址改为缓存地址，缓存地址不比原地址短时保留原地址，返回(改写次数, 减少的字节数)
+def rewrite_logos(streams, logo_map):
+    rewritten = saved = 0
+    for stream in streams:
+        cached = logo_map.get(stream.get('tvg-logo', ''))
+        if cached is None:
+            continue
+        shorter = len(stream['tvg-logo'].encode('utf-8')) - len(cached.encode('utf-8'))
+        if shorter > 0:
+            rewritten += 1
+            saved += shorter
+            stream['tvg-logo'] = cached
+    return rewritten, saved
+
+# 打开EPG文件，按文件头判断是否为gzip压缩，不依赖扩展名
+def open_epg(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+    if magic == b'\x1f\x8b':
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+# XMLTV时间格式为 "20240101120000 +0800"，没有时区时按UTC处理
+def parse_xmltv_time(value):
+    value = (value or '').strip()
+    try:
+        if len(value) > 14:
+            return datetime.strptime(value[:14] + value[14:].replace(' ', ''), '%Y%m%d%H%M%S%z')
+        return datetime.strptime(value[:14], '%Y%m%d%H%M%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+# 流式解析一个XMLTV文件，只保留wanted（归一化名称 → 频道名）中的频道在时间窗口内的节目
+# 每处理完一个channel或programme元素就清空根元素，内存占用与文件大小无关
+def parse_xmltv(path, wanted, window_start, window_end):
+    channel_map = {}  # XMLTV频道id → 频道名
+    programmes = {}  # 频道名 → [(开始, 结束, 标题, 简介)]
+    root = None
+    skipped = 0
+    with open_epg(path) as f:
+        for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+            if root is None:
+                root = elem
+                continue
+            if event != 'end':
+                continue
+            if elem.tag == 'channel':
+                channel_id = elem.get('id', '')
+                for name in [channel_id] + [node.text or '' for node in elem.findall('display-name')]:
+                    channel = wanted.get(normalize_channel_name(name))
+                    if channel is not None:
+                        channel_map[channel_id] = channel
+                        break
+                root.clear()
+            elif elem.tag == 'programme':
+                channel = channel_map.get(elem.get('channel', ''))
+                if channel is not None:
+                    start = elem.get('start', '')
+                    stop = elem.get('stop', '')
+                    start_time = parse_xmltv_time(start)
+                    stop_time = parse_xmltv_time(stop) or start_time
+                    if start_time is not None and stop_time >= window_start and start_time <= window_end:
+                        programmes.setdefault(channel, []).append(
+                            (start, stop, elem.findtext('title', ''), elem.findtext('desc', '')))
+                    else:
+                        skipped += 1
+                root.clear()
+    return set(channel_map.values()), programmes, skipped
+
+# 下载EPG到临时文件（不读入内存），本地文件路径和file://地址直接使用
+async def download_epg(session, url, workdir):
+    if url.startswith('file://'):
+        return url[len('file://'):]
+    if not url.startswith(('http://', 'https://')):
+        return url if os.path.exists(url) else None
+    path = os.path.join(workdir, hashlib.sha1(url.encode('utf-8')).hexdigest()[:12])
+    try:
+        async with session.get(url, timeout=epg_download_timeout) as response:
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    f.write(chunk)
+        return path
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Error downloading EPG {url}: {str(e)}")
+        return None
+
+# 按最终频道列表裁剪合并各源的EPG，同一频道使用优先级最高的EPG，写入gzip压缩的XMLTV
+async def build_epg(ranked_streams, epg_sources_filename, output_epg_filename, now=None):
+    if not os.path.exists(epg_sources_filename):
+        print(f"没有找到 '{epg_sources_filename}'，跳过EPG")
+        return False
+    with open(epg_sources_filename, 'r', encoding='utf-8') as f:
+        epg_urls = json.load(f)
+
+    lineup = {}  # 频道名 → tvg-id，m3u中每个频道使用的直播源
+    for _, position, stream in ranked_streams:
+        if position == 0:
+            lineup[stream['tvg-name']] = stream.get('tvg-id') or stream['tvg-name']
+    now = now or datetime.now(timezone.utc)
+    window_start = now - timedelta(hours=epg_keep_past_hours)
+    window_end = now + timedelta(hours=epg_keep_future_hours)
+
+    programmes = {}
+    workdir = tempfile.mkdtemp()
+    try:
+        async with aiohttp.ClientSession() as session:
+            for url in epg_urls:
+                wanted = {normalize_channel_name(name): name for name in lineup if name not in programmes}
+                if not wanted:
+                    break
+                start = time.perf_counter()
+                path = await download_epg(session, url, workdir)
+                if path is None:
+                    continue
+                size = os.path.getsize(path)
+                try:
+                    # 解析是CPU密集的同步操作，放到线程中执行
+                    matched, source_programmes, skipped = await asyncio.to_thread(parse_xmltv, path, wanted, window_start, window_end)
+                except (OSError, EOFError, ElementTree.ParseError) as e:
+                    logging.error(f"Error parsing EPG {url}: {str(e)}")
+                    continue
+                finally:
+                    if path.startswith(workdir):
+                        os.remove(path)
+                # 只记录窗口内有节目的频道，没有节目的频道留给后面的EPG源
+                filled = [channel for channel in matched if source_programmes.get(channel)]
+                for channel in filled:
+                    programmes[channel] = sorted(source_programmes[channel])
+                print(f"EPG {url}：{size // 1024} KB，匹配 {len(matched)} 个频道（{len(filled)} 个有节目），"
+                      f"保留 {sum(len(programmes[channel]) for channel in filled)} 个节目，"
+                      f"窗口外 {skipped} 个，用时 {time.perf_counter() - start:.1f} 秒")
+    finally:
+        shutil.rmtree(workdir)
+
+    if not programmes:
+        print("EPG中没有匹配的频道")
+        return False
+
+    with gzip.open(output_epg_filename, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="iptv4">\n')
+        for channel in lineup:
+            if channel in programmes:
+                f.write(f'<channel id={quoteattr(lineup[channel])}><display-name>{escape(channel)}</display-name></channel>\n')
+        for channel in lineup:
+            for start, stop, title, desc in programmes.get(channel, []):
+                f.write(f'<programme channel={quoteattr(lineup[channel])} start={quoteattr(start)} stop={quoteattr(stop)}>'
+                        f'<title>{escape(title)}</title>')
+                if desc:
+                    f.write(f'<desc>{escape(desc)}</desc>')
+                f.write('</programme>\n')
+        f.write('</tv>\n')
+    print(f"EPG覆盖 {len(programmes)}/{len(lineup)} 个频道，已写入 '{output_epg_filename}'")
+    return True
 
 # 读取CSV文件
 def read_csv(csv_filename):
@@ -61,57 +2136,22 @@ def read_csv(csv_filename):
     return streams
 
 # 生成新的m3u文件，按照模板顺序保留每个tvg-name速度最快的直播源
-def generate_m3u_file(valid_streams, output_m3u_filename, template_order):
-    # 将有效流按模板顺序排序
-    ordered_streams = []
-    for tvg_name in template_order:
-        for stream in valid_streams:
-            if stream['tvg-name'] == tvg_name:
-                ordered_streams.append(stream)
-                break
-
+def generate_m3u_file(ranked_streams, output_m3u_filename, epg_url=None):
     with open(output_m3u_filename, 'w', newline='', encoding='utf-8') as m3ufile:
-        m3ufile.write('#EXTM3U\n')
-        for stream in ordered_streams:
+        m3ufile.write(f'#EXTM3U x-tvg-url="{epg_url}"\n' if epg_url else '#EXTM3U\n')
+        for _, position, stream in ranked_streams:
+            if position > 0:
+                continue
             m3ufile.write(f'#EXTINF:-1 tvg-name="{stream["tvg-name"]}" tvg-id="{stream["tvg-id"]}" tvg-logo="{stream["tvg-logo"]}" group-title="{stream["group-title"]}", {stream["tvg-name"]}\n')
             m3ufile.write(f'{stream["link"]}\n')
 
 # 生成新的txt文件，按照模板顺序保留每个tvg-name速度最快的10个直播源，并按连接速度排序
-def generate_txt_file(valid_streams, output_txt_filename, template_order):
-    # 按照模板顺序的group-title顺序
-    group_order = [
-        "央视频道",
-        "卫视频道",
-        "影视频道",
-        "数字频道",
-        "少儿频道",
-        "地方频道",
-        "港·澳·台"
-    ]
-
-    # 根据tvg-name分组，排序每组内的流
-    grouped_streams = {}
-    for stream in valid_streams:
-        tvg_name = stream['tvg-name']
-        if tvg_name not in grouped_streams:
-            grouped_streams[tvg_name] = []
-        grouped_streams[tvg_name].append(stream)
-
-    # 按模板顺序重排并按连接速度排序，每个tvg-name最多保留10个
-    ordered_streams = []
-    for tvg_name in template_order:
-        if tvg_name in grouped_streams:
-            streams = grouped_streams[tvg_name]
-            streams.sort(key=lambda x: x['speed'])  # 按连接速度排序
-            ordered_streams.extend(streams[:10])  # 只保留前10个
-
-    # 按group-title分组
+def generate_txt_file(ranked_streams, output_txt_filename):
+    # 按group-title分组，每个tvg-name最多保留10个
     streams_by_group = {}
-    for stream in ordered_streams:
-        group_title = stream["group-title"]
-        if group_title not in streams_by_group:
-            streams_by_group[group_title] = []
-        streams_by_group[group_title].append(stream)
+    for _, position, stream in ranked_streams:
+        if position < txt_streams_per_channel:
+            streams_by_group.setdefault(stream["group-title"], []).append(stream)
 
     with open(output_txt_filename, 'w', newline='', encoding='utf-8') as txtfile:
         for group_title in group_order:
@@ -124,68 +2164,376 @@ def generate_txt_file(valid_streams, output_txt_filename, template_order):
        #txtfile.write(f"vip客服:88164962,https://vd2.bdstatic.com/mda-phje20fz4z8h126t/720p/h264/1692525385713349507/mda-phje20fz4z8h126t.mp4?v_from_s=hkapp-haokan-hnb&auth_key=1692536679-0-0-384af0ac122eee8fab76c327a47308c4&bcevod_channel=searchbox_feed&cr=2&cd=0&pd=1&pt=3&logid=0279906713&vid=4268605015135290173&klogid=0279906713&abtest=111803_1-112162_2-112345_1\n")
 
 # 将有效直播源写入新的CSV文件，按照模板顺序一级排序，并且对相同tvg-name的直播源按速度二级排序
-def write_valid_streams_to_csv(valid_streams, output_csv_filename, template_order):
-    # 创建一个字典用于存储每个tvg-name对应的所有直播源
-    sorted_streams = {}
-    
-    # 将valid_streams按照tvg-name进行分组
-    for stream in valid_streams:
-        tvg_name = stream['tvg-name']
-        if tvg_name not in sorted_streams:
-            sorted_streams[tvg_name] = []
-        sorted_streams[tvg_name].append(stream)
-    
-    # 依次按照模板顺序将每组tvg-name的直播源排序并写入CSV文件
+# 文件每小时提交一次，不写入每次运行都会变化的速度和延迟统计（速度保存在链接索引库中）
+def write_valid_streams_to_csv(ranked_streams, output_csv_filename):
     with open(output_csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link', 'speed']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        fieldnames = ['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link']
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
         writer.writeheader()
-        
-        for tvg_name in template_order:
-            if tvg_name in sorted_streams:
-                streams = sorted_streams[tvg_name]
-                # 对相同tvg-name的直播源按速度进行排序
-                streams.sort(key=lambda x: x['speed'])
-                for stream in streams:
-                    writer.writerow(stream)
+        for _, _, stream in ranked_streams:
+            writer.writerow(stream)
+
+# 按源统计本次的有效直播源数量和探测成本，更新历史有效率并输出每个源的成本报告
+def update_source_stats(results, source_stats_filename):
+    run_stats = {}
+    for result in results:
+        source = result['stream'].get('source') or ''
+        if not source:
+            continue
+        stats = run_stats.setdefault(source, {'unique': 0, 'working': 0, 'probe_seconds': 0.0})
+        stats['unique'] += 1
+        stats['probe_seconds'] += result['cost']
+        if result['available']:
+            stats['working'] += 1
+
+    source_stats = {}
+    if os.path.exists(source_stats_filename):
+        try:
+            with open(source_stats_filename, 'r', encoding='utf-8') as f:
+                source_stats = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.error(f"Error reading {source_stats_filename}: {str(e)}")
+
+    # 本次没有出现的源（被跳过或抓取失败）保留原有统计
+    for source, stats in run_stats.items():
+        run_yield = stats['working'] / stats['unique']
+        previous = source_stats.get(source)
+        if previous:
+            source_yield = source_stats_alpha * run_yield + (1 - source_stats_alpha) * previous.get('yield', run_yield)
+            runs = previous.get('runs', 0) + 1
+        else:
+            source_yield = run_yield
+            runs = 1
+        source_stats[source] = {
+            'runs': runs,
+            'yield': round(source_yield, 4),
+            'unique': stats['unique'],
+            'working': stats['working'],
+            'probe_seconds': round(stats['probe_seconds'], 3),
+        }
+
+    with open(source_stats_filename, 'w', encoding='utf-8') as f:
+        json.dump(source_stats, f, ensure_ascii=False, indent=1, sort_keys=True)
+
+    print("每个源的探测成本：")
+    print(f"{'unique':>8} {'working':>8} {'yield':>7} {'probe s':>9} {'s/useful':>9}  source")
+    for source, stats in sorted(run_stats.items(), key=lambda item: -item[1]['working']):
+        cost_per_useful = stats['probe_seconds'] / stats['working'] if stats['working'] else float('inf')
+        print(f"{stats['unique']:>8} {stats['working']:>8} {stats['working'] / stats['unique']:>7.1%} "
+              f"{stats['probe_seconds']:>9.1f} {cost_per_useful:>9.2f}  {source}")
+
+# 打开(频道, 链接)索引库，库文件不存在时从导出文件重建
+def open_link_index(link_index_filename, link_index_export_filename):
+    exists = os.path.exists(link_index_filename)
+    conn = sqlite3.connect(link_index_filename)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS streams (
+            channel TEXT NOT NULL,
+            link TEXT NOT NULL,
+            tvg_id TEXT,
+            tvg_logo TEXT,
+            group_title TEXT,
+            source TEXT,
+            available INTEGER NOT NULL DEFAULT 0,
+            speed REAL,
+            fail_count INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (channel, link)
+        ) WITHOUT ROWID
+    ''')
+    # 库文件丢失（缓存未命中）时从导出文件重建：导出中没有来源、速度和最后出现时间，失效链接按连续失败一次计
+    # 最后出现时间记为重建时间，这些链接在之后的运行中不再出现时，保留期从重建时开始计算
+    if not exists and os.path.exists(link_index_export_filename):
+        now = int(time.time())
+        with open(link_index_export_filename, 'r', newline='', encoding='utf-8') as csvfile:
+            rows = [(row['tvg-name'], row['link'], row['tvg-id'], row['tvg-logo'], row['group-title'], row.get('source', ''),
+                     int(row['available']), None, 0 if int(row['available']) else 1, now)
+                    for row in csv.DictReader(csvfile)]
+        conn.executemany('INSERT OR REPLACE INTO streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    conn.commit()
+    return conn
+
+# 将本次探测结果增量合并进索引，失败的链接累计连续失败次数
+def merge_probe_results(conn, results, now=None):
+    now = int(now if now is not None else time.time())
+    rows = []
+    for result in results:
+        stream = result['stream']
+        available = 1 if result['available'] else 0
+        rows.append((stream['tvg-name'], stream['link'], stream.get('tvg-id', ''), stream.get('tvg-logo', ''),
+                     stream.get('group-title', ''), stream.get('source', ''), available,
+                     stream.get('speed') if available else None, 0 if available else 1, now))
+    conn.executemany('''
+        INSERT INTO streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (channel, link) DO UPDATE SET
+            tvg_id = excluded.tvg_id,
+            tvg_logo = excluded.tvg_logo,
+            group_title = excluded.group_title,
+            source = excluded.source,
+            available = excluded.available,
+            speed = excluded.speed,
+            fail_count = CASE WHEN excluded.available THEN 0 ELSE streams.fail_count + 1 END,
+            last_seen = excluded.last_seen
+    ''', rows)
+    conn.execute('DELETE FROM streams WHERE last_seen < ?', (now - link_index_keep_seconds,))
+    conn.commit()
+
+# 按频道查询索引中的链接，可用的在前并按速度排序
+def lookup_channel(conn, channel):
+    cursor = conn.execute('''
+        SELECT link, available, speed, fail_count FROM streams
+        WHERE channel = ? ORDER BY available DESC, speed, link
+    ''', (channel,))
+    return cursor.fetchall()
+
+# 按(频道, 链接)顺序导出索引，只有链接出现、消失或可用状态改变时对应的行才会变化
+def export_link_index(conn, link_index_export_filename):
+    with open(link_index_export_filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile, lineterminator='\n')
+        writer.writerow(link_index_fields)
+        writer.writerows(conn.execute('''
+            SELECT channel, link, tvg_id, tvg_logo, group_title, available
+            FROM streams ORDER BY channel, link
+        '''))
 
 # 验证直播源并生成文件
-async def validate_and_generate_files(csv_filename, output_m3u_filename, output_txt_filename, output_csv_filename, template_filename):
-    global progress_bar
+async def validate_and_generate_files(csv_filename, output_m3u_filename, output_txt_filename, output_csv_filename, template_filename, liveness=False, resume=False, publish_partial=False, dual_stack=False, logos=False, epg=False, samples=0, fingerprint=False, budget=None, prescreen=False, logo_url=logo_base_url):
+    global progress_bar, ranking_weights
     valid_streams = []
-    streams = read_csv(csv_filename)
+    run_start = time.perf_counter()
+    probe_deadline = run_start + budget * (1 - budget_finalize_share) if budget else None
+    first_output = []  # 第一次生成可用输出文件的时间
+    with run_profiler.stage(profiler, 'read'):
+        streams = read_csv(csv_filename)
+
+        # 跳过最近失效过的链接
+        dead_filter = DeadLinkFilter.load(dead_filter_filename)
+        dead_filter.rotate()
+        streams, rechecks, known_dead = filter_known_dead(streams, dead_filter)
+
+        # 跳过在下一次发布前就会过期的带鉴权链接
+        previous_total, previous_expired = count_expired_published(output_txt_filename)
+        streams, expiring = filter_expiring(streams)
+
+        # 从检查点恢复本次运行中已经探测过的直播源
+        checkpoint = ProbeCheckpoint(checkpoint_filename, resume)
+        resumed_results, streams = checkpoint.split(streams)
+        if resume:
+            print(f"从检查点恢复 {len(resumed_results)} 个探测结果")
 
     # 创建tqdm实例并设置总长度
     progress_bar = tqdm(total=len(streams), desc="Validating streams")
 
-    # 创建信号量，控制并发数量
-    sem = asyncio.Semaphore(50)
+    # 一个层级（例如央视频道）及之前的层级全部探测完成后，提前生成一次m3u和txt文件
+    template = compile_template(template_filename, template_cache_filename)
 
-    async with aiohttp.ClientSession() as session:
-        tasks = [test_stream_quality(sem, session, stream) for stream in streams]
-        results = await asyncio.gather(*tasks)
+    # 双栈模式下主输出只保留IPv4可用的直播源，提前生成的文件也一样
+    def on_tier_done(tier, done_results):
+        if not publish_partial:
+            return
+        tier_name = group_order[tier] if tier < len(group_order) else '其他频道'
+        available = [result['stream'] for result in done_results if result['available']]
+        if dual_stack:
+            record_families(available, families)
+            available = [stream for stream in available if in_family_lineup(stream, 'ipv4')]
+        ranked_streams = rank_streams(available, template)
+        generate_m3u_file(ranked_streams, output_m3u_filename)
+        generate_txt_file(ranked_streams, output_txt_filename)
+        if not first_output:
+            first_output.append(time.perf_counter() - run_start)
+        tqdm.write(f"{tier_name}探测完成，已提前生成 '{output_m3u_filename}' 和 '{output_txt_filename}'")
+
+    # 持久化DNS缓存和主机熔断器
+    host_cache = load_host_cache(host_cache_filename)
+    resolver = CachingResolver(host_cache['dns'])
+    breaker = HostBreaker(host_cache['dead_hosts'])
+    relays = RelayMonitor()
+    protocols = ProtocolMonitor()
+    redirects = RedirectCache(host_cache['redirects'])
+    connector = aiohttp.TCPConnector(resolver=resolver)
+
+    with run_profiler.stage(profiler, 'probe'):
+        if profiler is not None:
+            lag_watcher = asyncio.ensure_future(profiler.watch_loop_lag())
+        # 双栈模式下先对每个主机做IPv4/IPv6竞速
+        if dual_stack:
+            families = await probe_host_families(resolver, streams)
 
+        # 可选的TCP预筛，连不上的主机上的直播源不再做HTTP探测
+        screened_results = []
+        if prescreen:
+            streams, screened_results = await prescreen_streams(resolver, streams, families if dual_stack else None)
+            progress_bar.total = len(streams)
+            progress_bar.refresh()
+
+        async with aiohttp.ClientSession(connector=connector) as session:
+            flusher = asyncio.ensure_future(checkpoint.flush_periodically())
+            try:
+                if budget:
+                    priors = load_probe_priors(link_index_filename, link_index_export_filename, source_stats_filename)
+                    probe_results, limiter = await probe_streams_budget(session, streams, template, breaker, checkpoint, relays, redirects,
+                                                                        protocols, priors, probe_deadline, budget)
+                else:
+                    probe_results, limiter = await probe_streams(session, streams, template, breaker, checkpoint, on_tier_done, relays, redirects,
+                                                                 protocols, rechecks)
+                results = resumed_results + probe_results + screened_results
+                if prescreen:
+                    report_funnel(len(streams) + len(screened_results), screened_results, probe_results)
+            finally:
+                flusher.cancel()
+                checkpoint.flush()
+
+            # 可选的内容指纹，合并同一内容的直播源
+            if fingerprint:
+                await within_budget(fingerprint_streams(limiter.slot(0), session, results, template), probe_deadline, '内容指纹')
+
+            # 可选的活跃性检查
+            if liveness:
+                await within_budget(verify_liveness(limiter.slot(0), session, results, template), probe_deadline, '活跃性检查')
+
+            # 可选的多次延迟采样，之后的排序改用采样统计；采样没有完成时仍按单次探测的速度排序
+            if samples:
+                sampled, _ = await within_budget(sample_latency(limiter.slot(0), session, results, template, samples), probe_deadline, '延迟采样')
+                if sampled:
+                    ranking_weights = sampled_ranking_weights
+                else:
+                    samples = 0
+        if profiler is not None:
+            lag_watcher.cancel()
+
+    await resolver.close()
+    save_host_cache(host_cache_filename, resolver, breaker, redirects)
+    print(f"DNS缓存：命中 {resolver.hits} 次，解析 {resolver.misses} 次")
+    breaker.report()
+    relays.report()
+    protocols.report()
+    redirects.report()
+
+    # 记录每个直播源可用的地址族和连接耗时
+    if dual_stack:
+        record_families([result['stream'] for result in results], families)
+
+    # 记录本次失效的链接，命中过滤器但复查可用的链接计为误判或已恢复
+    recheck_links = {stream['link'] for stream in rechecks}
+    revived = 0
     for result in results:
         if result['available']:
             valid_streams.append(result['stream'])
+            if result['stream']['link'] in recheck_links:
+                revived += 1
+        elif 'link' in result['stream']:
+            dead_filter.add(result['stream']['link'])
+    dead_filter.save(dead_filter_filename)
+    print(f"已知失效过滤：跳过 {len(known_dead)} 次探测，抽样复查 {len(rechecks)} 个（{revived} 个可用），"
+          f"过滤器占用 {dead_filter.memory_bytes() // 1024} KB，当前一代填充率 {dead_filter.fill_ratio():.1%}")
+
+    # 已知失效而跳过的链接按失效计入源统计和链接索引；将要过期的链接没有探测过，不计入统计
+    results += [{'stream': stream, 'available': False, 'cost': 0.0} for stream in known_dead]
+    tokenized = [token for token in (parse_token_expiry(stream['link']) for stream in valid_streams) if token is not None]
+    print(f"鉴权链接：跳过 {len(expiring)} 个将在 {token_publish_interval // 60} 分钟内过期的链接，"
+          f"有效链接中 {len(tokenized)} 个带鉴权参数（{sum(1 for token in tokenized if token[1] is None)} 个看不出过期时间）；"
+          f"上一次发布的 {previous_total} 个链接中 {previous_expired} 个在发布窗口内过期")
 
     # 关闭进度条
     progress_bar.close()
 
-    # 读取模板文件中的顺序
-    template_order = read_template(template_filename)
+    with run_profiler.stage(profiler, 'stats'):
+        # 更新每个源的有效率统计
+        update_source_stats(results, source_stats_filename)
 
-    # 生成新的m3u文件，按照模板顺序保留每个tvg-name速度最快的直播源
-    generate_m3u_file(valid_streams, output_m3u_filename, template_order)
+        # 将探测结果合并进(频道, 链接)索引并导出
+        conn = open_link_index(link_index_filename, link_index_export_filename)
+        merge_probe_results(conn, results)
+        export_link_index(conn, link_index_export_filename)
+        conn.close()
 
-    # 生成新的txt文件，按照模板顺序保留每个tvg-name速度最快的10个直播源，并按连接速度排序
-    generate_txt_file(valid_streams, output_txt_filename, template_order)
+    # 可选：缓存台标并改写输出文件中的台标地址
+    if logos:
+        fetched, logo_map = await within_budget(prefetch_logos(valid_streams, logo_url), probe_deadline, '台标下载')
+        rewritten, saved = rewrite_logos(valid_streams, logo_map if fetched else {})
+        print(f"台标地址改写 {rewritten} 处，valid_streams.csv中的台标字段减少 {saved} 字节")
 
-    # 将有效直播源写入新的CSV文件，按照模板顺序
-    write_valid_streams_to_csv(valid_streams, output_csv_filename, template_order)
+    # 可选：按主频道列表裁剪合并EPG，m3u文件头指向合并后的EPG
+    epg_url = None
+    if epg:
+        with run_profiler.stage(profiler, 'epg'):
+            built, written = await within_budget(build_epg(rank_streams(valid_streams, template), epg_sources_filename, output_epg_filename),
+                                                 probe_deadline, 'EPG')
+            if built and written:
+                epg_url = epg_public_url
 
-    print(f"生成新的文件 '{output_m3u_filename}', '{output_txt_filename}' 和 '{output_csv_filename}' 成功。")
+    # 读取编译后的模板，按模板排名对有效直播源排序一次，供所有输出文件使用
+    # 双栈模式下主输出只保留IPv4可用的直播源，另外生成一份IPv6可用的列表
+    lineups = [(template_filename, output_m3u_filename, output_txt_filename, output_csv_filename, 'ipv4' if dual_stack else None)]
+    if dual_stack:
+        lineups.append((template_filename, f'{ipv6_output_prefix}.m3u', f'{ipv6_output_prefix}.txt',
+                        f'valid_streams_{ipv6_output_prefix}.csv', 'ipv6'))
+    for lineup_template, output_prefix in template_lineups:
+        lineups.append((lineup_template, f'{output_prefix}.m3u', f'{output_prefix}.txt', f'{output_prefix}.csv', None))
+
+    with run_profiler.stage(profiler, 'write'):
+        for lineup_template, lineup_m3u, lineup_txt, lineup_csv, family in lineups:
+            template = compile_template(lineup_template, template_cache_filename)
+            lineup_streams = valid_streams
+            if family is not None:
+                lineup_streams = [stream for stream in valid_streams if in_family_lineup(stream, family)]
+            ranked_streams = rank_streams(lineup_streams, template)
+            if fingerprint:
+                ranked_streams = diversify_ranking(ranked_streams, report=lineup_m3u == output_m3u_filename)
+
+            # 生成新的m3u文件，按照模板顺序保留每个tvg-name速度最快的直播源
+            generate_m3u_file(ranked_streams, lineup_m3u, epg_url if lineup_m3u == output_m3u_filename else None)
+            if lineup_m3u == output_m3u_filename:
+                report_ranking_stability(ranked_streams, 'sampled' if samples else 'single', ranking_history_filename)
+                schedule = write_token_schedule(ranked_streams, token_schedule_filename)
+                if schedule:
+                    print(f"已发布链接中 {len(schedule)} 个有过期时间，最早需要在 "
+                          f"{datetime.fromtimestamp(schedule[0]['reprobe_at']).strftime('%Y-%m-%d %H:%M:%S')} 重新探测，计划见 '{token_schedule_filename}'")
+
+            # 生成新的txt文件，按照模板顺序保留每个tvg-name速度最快的10个直播源，并按连接速度排序
+            generate_txt_file(ranked_streams, lineup_txt)
+
+            # 将有效直播源写入新的CSV文件，按照模板顺序
+            write_valid_streams_to_csv(ranked_streams, lineup_csv)
+
+            print(f"生成新的文件 '{lineup_m3u}', '{lineup_txt}' 和 '{lineup_csv}' 成功。")
+
+    # 输出文件全部生成后删除检查点
+    checkpoint.close(remove=True)
+
+    total_time = time.perf_counter() - run_start
+    if not first_output:
+        first_output.append(total_time)
+    print(f"首个可用输出用时 {first_output[0]:.1f} 秒，总用时 {total_time:.1f} 秒" + (f"（预算 {budget:.0f} 秒）" if budget else ''))
 
 # 主程序入口
 if __name__ == "__main__":
-    asyncio.run(validate_and_generate_files(csv_filename, output_m3u_filename, output_txt_filename, output_csv_filename, template_filename))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true', help='输出性能分析结果（火焰图折叠栈、各阶段摘要和异步探测阶段耗时）')
+    parser.add_argument('--liveness', action='store_true', help='检查每个频道前几个m3u8直播源的播放列表是否在更新')
+    parser.add_argument('--resume', action='store_true', help='从上次中断的检查点继续，跳过已经探测过的直播源')
+    parser.add_argument('--publish-partial', action='store_true', help='高优先级层级探测完成后提前生成m3u和txt文件')
+    parser.add_argument('--dual-stack', action='store_true', help='IPv4/IPv6竞速探测，分别生成iptv4和iptv6列表')
+    parser.add_argument('--logos', action='store_true', help='下载台标到本地缓存，并将输出文件中的台标地址改为缓存地址')
+    parser.add_argument('--logo-base-url', default=logo_base_url, help='缓存台标的地址前缀，只有改写后更短的台标地址才会改写')
+    parser.add_argument('--epg', action='store_true', help='按最终频道列表裁剪合并各源的EPG，生成iptv4.xml.gz')
+    parser.add_argument('--samples', type=int, default=0, help='对每个频道排名靠前的直播源测量N次首字节时间，按中位数、p90和抖动排序')
+    parser.add_argument('--fingerprint', action='store_true', help='按内容指纹合并同一内容的m3u8直播源，txt文件中每个频道分散到不同内容和主机')
+    parser.add_argument('--budget', type=float, default=None, help='运行时间预算（秒），优先覆盖更多模板频道，到时取消剩余探测并用已有结果生成文件')
+    parser.add_argument('--prescreen', action='store_true', help='HTTP探测前先对每个主机:端口做一次TCP连接，跳过连不上的主机上的直播源')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler = run_profiler.RunProfiler('live_streams')
+        profiler.start()
+    asyncio.run(validate_and_generate_files(csv_filename, output_m3u_filename, output_txt_filename, output_csv_filename, template_filename,
+                                            liveness=args.liveness, resume=args.resume,
+                                            publish_partial=args.publish_partial, dual_stack=args.dual_stack,
+                                            logos=args.logos, epg=args.epg, samples=args.samples,
+                                            fingerprint=args.fingerprint, budget=args.budget,
+                                            prescreen=args.prescreen, logo_url=args.logo_base_url))
+    if profiler is not None:
+        profiler.stop()
+        profiler.write()
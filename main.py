@@ -1,8 +1,39 @@
 import requests
 import csv
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import json
+import time
+import gzip
+import zlib
+import codecs
+import hashlib
+import argparse
+import threading
+import urllib3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tqdm import tqdm
+import profiler as run_profiler
+import linkset
+
+# 可选的解压库，安装了才在Accept-Encoding中声明br和zstd
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 读取和解压响应体时可能抛出的异常：urllib3的读超时和连接中断不会包装成requests的异常
+stream_errors = (requests.RequestException, urllib3.exceptions.HTTPError, ValueError, zlib.error, EOFError)
+if brotli is not None:
+    stream_errors += (brotli.error,)
+if zstandard is not None:
+    stream_errors += (zstandard.ZstdError,)
 
 # 定义要抓取的m3u直播源链接列表
 m3u_urls = [
@@ -19,96 +50,478 @@ m3u_urls = [
 
 ]
 
-# 准备写入CSV文件的字段名
-fieldnames = ['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link']
+# 准备写入CSV文件的字段名，source记录直播源来自哪个m3u链接
+fieldnames = ['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link', 'source']
 
 # 初始化CSV写入器
 csv_filename = 'live_streams.csv'
 
-def process_playlist(m3u_url):
+# 每个源的历史有效率统计，由live_streams.csv.py在验证后更新
+source_stats_filename = 'source_stats.json'
+source_min_runs = 3  # 至少统计过几次才按有效率调度
+source_skip_yield = 0.01  # 有效率低于1%的源直接跳过
+source_throttle_yield = 0.05  # 有效率低于5%的源限流
+source_throttle_limit = 500  # 限流源最多保留的直播源数量
+source_recheck_hours = 6  # 被跳过的源每隔几个小时重新检查一次
+
+# GitHub源的镜像地址模板，同一个文件的多个镜像错开启动竞速，最先返回完整有效内容的镜像胜出
+# {owner}/{repo}/{ref}/{path} 取自 https://github.com/{owner}/{repo}/raw/{ref}/{path}，{url} 为原地址
+# 只使用直接转发raw.githubusercontent.com的镜像：jsDelivr按分支名的地址有数小时的CDN缓存，竞速中常常胜出却返回旧的播放列表
+mirror_templates = [
+    'https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}',
+    'https://mirror.ghproxy.com/https://raw.githubusercontent.com/{owner}/{repo}/{ref}/{path}',
+    '{url}',
+]
+mirror_stats_filename = 'mirror_stats.json'  # 每个镜像的平均耗时，决定下次竞速的启动顺序
+mirror_stagger = 0.5  # 相邻两个镜像的启动间隔（秒）
+mirror_timeout = 10  # 单个镜像的超时（秒）
+mirror_stats_alpha = 0.3  # 镜像耗时滑动平均的权重
+mirror_lock = threading.Lock()
+source_cache_dir = 'source_cache'  # 每个源最近一次完整下载的gzip压缩副本，所有镜像都失败时使用
+transfer_chunk_size = 64 * 1024  # 每次从连接读取的字节数
+github_raw_pattern = re.compile(r'^https://github\.com/([^/]+)/([^/]+)/raw/([^/]+)/(.+)$')
+stream_schemes = ('http://', 'https://', 'rtmp://', 'rtsp://', 'udp://')  # 保留的直播源链接协议，非HTTP协议由live_streams.csv.py的协议探测处理
+
+# 上一次运行所有链接的指纹，用于统计本次新出现的链接
+link_fingerprints_filename = 'link_fingerprints.npy'
+dedup_batch = 100000  # 去重时每批处理的直播源数量，不需要一次生成所有链接的列表
+
+# 各源文件头中声明的EPG地址（x-tvg-url / url-tvg），由live_streams.csv.py按最终频道列表裁剪合并
+epg_sources_filename = 'epg_sources.json'
+
+# 读取每个源的历史统计
+def load_source_stats(source_stats_filename):
+    if not os.path.exists(source_stats_filename):
+        return {}
+    try:
+        with open(source_stats_filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Failed to read {source_stats_filename}: {str(e)}")
+        return {}
+
+# 按历史有效率排列源的抓取顺序，并决定跳过或限流的源
+def plan_sources(m3u_urls, source_stats):
+    recheck = datetime.now().hour % source_recheck_hours == 0
+    plan = []
+    for index, m3u_url in enumerate(m3u_urls):
+        stats = source_stats.get(m3u_url)
+        limit = None
+        if stats and stats.get('runs', 0) >= source_min_runs:
+            source_yield = stats.get('yield', 0.0)
+            if source_yield < source_skip_yield and not recheck:
+                print(f"Skipping {m3u_url}: yield {source_yield:.2%}")
+                continue
+            if source_yield < source_throttle_yield:
+                limit = source_throttle_limit
+        plan.append((m3u_url, limit, index))
+
+    # 有效率高的源排在前面，没有统计的源按原顺序排在最后
+    def priority(item):
+        stats = source_stats.get(item[0])
+        if stats and stats.get('runs', 0) >= source_min_runs:
+            return (0, -stats.get('yield', 0.0), item[2])
+        return (1, 0, item[2])
+
+    plan.sort(key=priority)
+    return [(m3u_url, limit) for m3u_url, limit, _ in plan]
+
+# 列出一个源的所有镜像地址，按历史平均耗时排序，没有记录的镜像保持模板顺序排在前面以便测量
+def mirror_urls(m3u_url, mirror_stats):
+    match = github_raw_pattern.match(m3u_url)
+    if not match:
+        return [('{url}', m3u_url)]
+    owner, repo, ref, path = match.groups()
+    candidates = []
+    for template in mirror_templates:
+        url = template.format(owner=owner, repo=repo, ref=ref, path=path, url=m3u_url)
+        if url not in [candidate for _, candidate in candidates]:
+            candidates.append((template, url))
+    return sorted(candidates, key=lambda item: mirror_stats.get(item[0], {}).get('latency', 0.0))
+
+# 声明可以解压的编码
+def accept_encoding():
+    encodings = ['gzip', 'deflate']
+    if brotli is not None:
+        encodings.append('br')
+    if zstandard is not None:
+        encodings.append('zstd')
+    return ', '.join(encodings)
+
+# 按Content-Encoding返回增量解压函数
+def make_decoder(content_encoding):
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    if encoding == 'deflate':
+        return zlib.decompressobj().decompress
+    if encoding == 'br' and brotli is not None:
+        return brotli.Decompressor().process
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj().decompress
+    if encoding == 'identity':
+        return lambda data: data
+    raise ValueError(f"Unsupported Content-Encoding: {encoding}")
+
+# 找到可以切分的位置：前一行是直播源链接（stream_schemes中的协议）的#EXTINF
+# 原正则中没有这些协议链接的条目会一直匹配到下一个链接，只在这种位置切分，结果才与整段解析一致
+def find_cut(text):
+    cut = text.rfind('#EXTINF')
+    while cut > 0:
+        line_start = text.rfind('\n', 0, cut - 1) + 1
+        if text.startswith(stream_schemes, line_start):
+            return cut
+        cut = text.rfind('#EXTINF', 0, cut)
+    return -1
+
+# 增量解析器：每收到一段文本，就解析切分位置之前的完整条目，只保留未完成的部分
+class PlaylistParser:
+    def __init__(self, m3u_url, limit=None):
+        self.m3u_url = m3u_url
+        self.limit = limit
+        self.pending = ''
+        self.head = ''  # 前1024个字符，用于读取文件头和判断内容是否为m3u
+        self.streams = []
+        self.decoded_bytes = 0
+        self.peak_buffer = 0
+        self.parse_time = 0.0
+        self.limit_reached = False  # 限流源已经取够limit个直播源，不必再下载
+
+    def feed(self, text, final=False):
+        start = time.perf_counter()
+        if len(self.head) < 1024:
+            self.head += text[:1024 - len(self.head)]
+        self.pending += text
+        self.peak_buffer = max(self.peak_buffer, len(self.pending))
+        cut = len(self.pending) if final else find_cut(self.pending)
+        if cut > 0 and not self.limit_reached:
+            block, self.pending = self.pending[:cut], self.pending[cut:]
+            remaining = None if self.limit is None else self.limit - len(self.streams)
+            self.streams += parse_streams(block, self.m3u_url, remaining)
+            self.limit_reached = self.limit is not None and len(self.streams) >= self.limit
+        self.parse_time += time.perf_counter() - start
+
+# 把原始字节流解压、解码后逐段交给解析器，同时写入压缩的本地副本
+# 返回传输统计，其中overlap是在传输过程中完成的解析耗时，即相对先下载后解析节省的时间
+def stream_playlist(chunks, parser, content_encoding, cache_path=None, cancelled=None):
+    decode = make_decoder(content_encoding)
+    text_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    start = time.perf_counter()
+    wire_bytes = 0
+    cache = None
+    if cache_path is not None:
+        # 源本身是gzip压缩时直接保存收到的字节，不再重新压缩
+        cache = open(cache_path, 'wb') if content_encoding == 'gzip' else gzip.open(cache_path, 'wb', compresslevel=6)
+    try:
+        for chunk in chunks:
+            if cancelled is not None and cancelled.is_set():
+                return None
+            wire_bytes += len(chunk)
+            data = decode(chunk)
+            parser.decoded_bytes += len(data)
+            if cache is not None:
+                cache.write(chunk if content_encoding == 'gzip' else data)
+            parser.feed(text_decoder.decode(data))
+            if parser.limit_reached:
+                break
+        overlap = parser.parse_time
+        transfer_time = time.perf_counter() - start
+        parser.feed(text_decoder.decode(b'', final=True), final=True)
+    finally:
+        if cache is not None:
+            cache.close()
+    return {
+        'streams': parser.streams,
+        'head': parser.head,
+        'encoding': content_encoding or 'identity',
+        'wire_bytes': wire_bytes,
+        'decoded_bytes': parser.decoded_bytes,
+        'transfer_time': transfer_time,
+        'parse_time': parser.parse_time,
+        'overlap': overlap,
+        'peak_buffer': parser.peak_buffer,
+        'complete': not parser.limit_reached,
+    }
+
+def source_cache_path(m3u_url):
+    return os.path.join(source_cache_dir, hashlib.sha1(m3u_url.encode('utf-8')).hexdigest()[:16] + '.m3u.gz')
+
+# 从一个镜像边下载边解析，delay秒后才开始；其他镜像已经胜出时放弃下载
+# 下载的内容写入临时文件cache_path，胜出后由race_mirrors替换本地副本，其他情况删除
+def fetch_mirror(url, delay, cancelled, m3u_url, limit, cache_path):
+    if cancelled.wait(delay):
+        return 'skipped', None
+    status, result = download_mirror(url, cancelled, m3u_url, limit, cache_path)
+    # 其他镜像已经胜出时，这次的结果不会再被使用
+    if status == 'ok' and cancelled.is_set():
+        status = 'cancelled'
+    if status != 'ok' and os.path.exists(cache_path):
+        os.remove(cache_path)
+    return status, result
+
+def download_mirror(url, cancelled, m3u_url, limit, cache_path):
+    try:
+        with requests.get(url, timeout=mirror_timeout, stream=True, headers={'Accept-Encoding': accept_encoding()}) as response:
+            if response.status_code != 200:
+                return 'failed', None
+            content_encoding = (response.headers.get('Content-Encoding') or '').strip().lower() or None
+            result = stream_playlist(response.raw.stream(transfer_chunk_size, decode_content=False),
+                                     PlaylistParser(m3u_url, limit), content_encoding, cache_path, cancelled)
+    except stream_errors as e:
+        print(f"Mirror {url} failed: {str(e)}")
+        return 'failed', None
+    if result is None:
+        return 'cancelled', None
+    # 镜像可能返回错误页面，只接受m3u内容
+    if '#EXTM3U' not in result['head'] and '#EXTINF' not in result['head'] and not result['streams']:
+        return 'failed', None
+    return 'ok', result
+
+# 所有镜像都失败时使用本地副本
+def load_cached_source(m3u_url, limit=None):
+    cache_path = source_cache_path(m3u_url)
+    if not os.path.exists(cache_path):
+        return None
+    age = (time.time() - os.path.getmtime(cache_path)) / 3600
+    print(f"Using cached copy of {m3u_url} ({age:.1f} h old)")
+    with open(cache_path, 'rb') as f:
+        result = stream_playlist(iter(lambda: f.read(transfer_chunk_size), b''), PlaylistParser(m3u_url, limit), 'gzip')
+    result['encoding'] = 'cached gzip'
+    return result
+
+# 输出每个源的传输统计：线路上的字节数、解压后的字节数、与传输重叠的解析耗时和最大缓冲
+def report_transfer(m3u_url, result):
+    ratio = result['wire_bytes'] / result['decoded_bytes'] if result['decoded_bytes'] else 1.0
+    print(f"{m3u_url}: {result['encoding']} {result['wire_bytes'] // 1024} KB on the wire "
+          f"({result['decoded_bytes'] // 1024} KB decoded, {ratio:.0%}), transfer {result['transfer_time']:.2f} s, "
+          f"parse {result['parse_time']:.3f} s of which {result['overlap']:.3f} s overlapped the transfer, "
+          f"peak buffer {result['peak_buffer'] // 1024} KB")
+
+# 记录一个镜像的耗时，result为 'win'、'failed'（按超时计入）或 'lost'（seconds只是下限，只会调高平均耗时）
+def record_mirror(mirror_stats, template, seconds, result):
+    with mirror_lock:
+        stats = mirror_stats.setdefault(template, {'latency': seconds, 'wins': 0, 'failures': 0})
+        if result == 'lost':
+            seconds = max(seconds, stats['latency'])
+        stats['latency'] = (1 - mirror_stats_alpha) * stats['latency'] + mirror_stats_alpha * seconds
+        if result == 'win':
+            stats['wins'] += 1
+        elif result == 'failed':
+            stats['failures'] += 1
+
+# 错开启动各镜像的下载，返回最先完成的有效内容，其余镜像随即放弃
+def race_mirrors(m3u_url, limit, mirror_stats):
+    candidates = mirror_urls(m3u_url, mirror_stats)
+    cancelled = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(candidates))
+    os.makedirs(source_cache_dir, exist_ok=True)
+    cache_path = source_cache_path(m3u_url)
+    # 清理上次运行中落选镜像可能残留的临时文件
+    for filename in os.listdir(source_cache_dir):
+        if filename.startswith(os.path.basename(cache_path) + '.') and filename.endswith('.tmp'):
+            os.remove(os.path.join(source_cache_dir, filename))
+    start = time.perf_counter()
+    futures = {executor.submit(fetch_mirror, url, index * mirror_stagger, cancelled, m3u_url, limit, f'{cache_path}.{index}.tmp'): (index, template)
+               for index, (template, url) in enumerate(candidates)}
+    content = None
+    try:
+        pending = set(futures)
+        while pending and content is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, template = futures[future]
+                status, body = future.result()
+                elapsed = time.perf_counter() - start - index * mirror_stagger
+                if status == 'ok' and content is None:
+                    content = body
+                    record_mirror(mirror_stats, template, elapsed, 'win')
+                    # 限流源只下载了一部分，不替换本地副本
+                    if body['complete']:
+                        os.replace(f'{cache_path}.{index}.tmp', cache_path)
+                    else:
+                        os.remove(f'{cache_path}.{index}.tmp')
+                    print(f"Fetched {m3u_url} via {template.split('/')[2] if '://' in template else 'origin'} in {elapsed:.2f} s")
+                elif status == 'failed':
+                    record_mirror(mirror_stats, template, mirror_timeout, 'failed')
+                elif status == 'ok':
+                    os.remove(f'{cache_path}.{index}.tmp')
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # 被放弃的镜像至少比胜出者慢，按已经运行的时间计入
+    if content is not None:
+        elapsed = time.perf_counter() - start
+        for future, (index, template) in futures.items():
+            if not future.done() and elapsed > index * mirror_stagger:
+                record_mirror(mirror_stats, template, elapsed - index * mirror_stagger, 'lost')
+    return content
+
+# 从#EXTM3U文件头中取出EPG地址，一个属性中可能用逗号分隔多个地址
+def extract_epg_urls(playlist_content):
+    header = playlist_content.lstrip('\ufeff').split('\n', 1)[0]
+    if not header.startswith('#EXTM3U'):
+        return []
+    epg_urls = []
+    for value in re.findall(r'(?:x-tvg-url|url-tvg)="(.*?)"', header, re.IGNORECASE):
+        epg_urls += [url.strip() for url in value.split(',') if url.strip()]
+    return epg_urls
+
+# 解析一段m3u内容中的直播流信息，最多返回limit个
+def parse_streams(content, m3u_url, limit=None):
+    # 使用正则表达式解析每条直播流信息
+    pattern = r'#EXTINF:-1(?: tvg-id="(.*?)")?(?: tvg-name="(.*?)")?(?: tvg-logo="(.*?)")?(?: group-title="(.*?)")?,\s*(.*?)\n((?:https?|rtmp|rtsp|udp)://[^\s]+)'
+    matches = re.findall(pattern, content, re.DOTALL | re.MULTILINE)
+
+    streams = []
+
+    # 处理匹配结果
+    for match in matches:
+        tvg_id = match[0] if match[0] else match[1]  # 如果tvg-id为空，则使用tvg-name作为tvg-id
+        tvg_name = match[1] if match[1] else ''
+        tvg_logo = match[2] if match[2] else ''
+        group_title = match[3] if match[3] else ''
+        stream_link = match[5].strip()
+
+        # 过滤掉包含.php的链接
+        if '.php' in stream_link:
+            continue
+
+        # 修改 group-title 标签
+        if group_title in ['内蒙频道', '浙江频道', '上海频道', '地方','广东频道']:
+            group_title = '地方频道'
+        elif group_title == 'NewTv':
+            group_title = '数字频道'
+        elif '卫视' in group_title:
+            group_title = '卫视频道'
+        elif group_title == '数字':
+            group_title = '数字频道'
+        elif group_title == '央视':
+            group_title = '央视频道'
+        elif group_title == 'NewTV频道':
+            group_title = '数字频道'                    
+        elif group_title == '动画频道':
+            group_title = '少儿频道' 
+        elif group_title == '港澳台频道':
+            group_title = '港·澳·台'
+          
+        # 修改 tvg-name 标签
+        tvg_name = re.sub(r'newtv', 'NewTv', tvg_name, flags=re.IGNORECASE)
+        if tvg_name == 'CCTV5PLUS':
+            tvg_name = 'CCTV5+'
+
+        # 根据特定条件删除直播源
+        if re.search(r'更新日期|日期|请阅读|yuanzl77.github.io|^$', tvg_name, re.IGNORECASE) or group_title == '公告':
+            continue  # 跳过符合条件的直播源
+
+        streams.append({
+            'tvg-name': tvg_name,
+            'tvg-id': tvg_id,
+            'tvg-logo': tvg_logo,
+            'group-title': group_title,
+            'link': stream_link,
+            'source': m3u_url
+        })
+
+        # 限流源只保留前limit个直播源
+        if limit is not None and len(streams) >= limit:
+            break
+
+    return streams
+
+def process_playlist(m3u_url, limit=None, mirror_stats=None):
     try:
         print(f"Processing {m3u_url}...")
-        response = requests.get(m3u_url, timeout=5)
-        if response.status_code == 200:
-            playlist_content = response.text
-
-            # 使用正则表达式解析每条直播流信息
-            pattern = r'#EXTINF:-1(?: tvg-id="(.*?)")?(?: tvg-name="(.*?)")?(?: tvg-logo="(.*?)")?(?: group-title="(.*?)")?,\s*(.*?)\n(https?://[^\s]+)'
-            matches = re.findall(pattern, playlist_content, re.DOTALL | re.MULTILINE)
-
-            streams = []
-
-            # 处理匹配结果
-            for match in matches:
-                tvg_id = match[0] if match[0] else match[1]  # 如果tvg-id为空，则使用tvg-name作为tvg-id
-                tvg_name = match[1] if match[1] else ''
-                tvg_logo = match[2] if match[2] else ''
-                group_title = match[3] if match[3] else ''
-                stream_link = match[5].strip()
-
-                # 过滤掉包含.php的链接
-                if '.php' in stream_link:
-                    continue
-
-                # 修改 group-title 标签
-                if group_title in ['内蒙频道', '浙江频道', '上海频道', '地方','广东频道']:
-                    group_title = '地方频道'
-                elif group_title == 'NewTv':
-                    group_title = '数字频道'
-                elif '卫视' in group_title:
-                    group_title = '卫视频道'
-                elif group_title == '数字':
-                    group_title = '数字频道'
-                elif group_title == '央视':
-                    group_title = '央视频道'
-                elif group_title == 'NewTV频道':
-                    group_title = '数字频道'                    
-                elif group_title == '动画频道':
-                    group_title = '少儿频道' 
-                elif group_title == '港澳台频道':
-                    group_title = '港·澳·台'
-                  
-                # 修改 tvg-name 标签
-                tvg_name = re.sub(r'newtv', 'NewTv', tvg_name, flags=re.IGNORECASE)
-                if tvg_name == 'CCTV5PLUS':
-                    tvg_name = 'CCTV5+'
-
-                # 根据特定条件删除直播源
-                if re.search(r'更新日期|日期|请阅读|yuanzl77.github.io|^$', tvg_name, re.IGNORECASE) or group_title == '公告':
-                    continue  # 跳过符合条件的直播源
-
-                streams.append({
-                    'tvg-name': tvg_name,
-                    'tvg-id': tvg_id,
-                    'tvg-logo': tvg_logo,
-                    'group-title': group_title,
-                    'link': stream_link
-                })
-
-            return streams
+        result = race_mirrors(m3u_url, limit, mirror_stats if mirror_stats is not None else {})
+        if result is None:
+            result = load_cached_source(m3u_url, limit)
+        if result is not None:
+            report_transfer(m3u_url, result)
+            return result['streams'], extract_epg_urls(result['head'])
         else:
-            print(f"Failed to fetch playlist from {m3u_url}. Status code: {response.status_code}")
-            return []
+            print(f"Failed to fetch playlist from {m3u_url} on any mirror")
+            return [], []
     except Exception as e:
         print(f"Exception while fetching {m3u_url}: {str(e)}")
-        return []
+        return [], []
 
 # 使用线程池进行并发请求和处理
-with ThreadPoolExecutor(max_workers=5) as executor, open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    writer.writeheader()
-
-    futures = [executor.submit(process_playlist, url) for url in m3u_urls]
-    
-    seen_links = set()  # 用于存放已经写入的直播源链接，用于去重
-
-    for future in tqdm(as_completed(futures), total=len(futures), desc="Processing playlists"):
-        streams = future.result()
-        for stream in streams:
-            # 去重处理
-            if stream['link'] not in seen_links:
-                seen_links.add(stream['link'])
-                # 写入CSV文件
-                writer.writerow(stream)
-
-print(f"CSV文件 '{csv_filename}' 生成成功。")
+def fetch_playlists(source_plan, mirror_stats):
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        futures = {executor.submit(process_playlist, url, limit, mirror_stats): url for url, limit in source_plan}
+        results = {}
+        epg_urls = {}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing playlists"):
+            results[futures[future]], epg_urls[futures[future]] = future.result()
+    return results, epg_urls
+
+# 按源的优先级顺序保存去重后的EPG地址，靠前的EPG在合并时优先
+def write_epg_sources(source_plan, epg_urls, epg_sources_filename):
+    ordered = []
+    for url, _ in source_plan:
+        for epg_url in epg_urls.get(url, []):
+            if epg_url not in ordered:
+                ordered.append(epg_url)
+    with open(epg_sources_filename, 'w', encoding='utf-8') as f:
+        json.dump(ordered, f, ensure_ascii=False, indent=1)
+    print(f"收集到 {len(ordered)} 个EPG地址")
+
+# 按源的优先级顺序写入，有效率高的源在去重时优先保留，验证时也优先探测
+# 去重使用规范化链接的定长指纹，不保存完整的链接字符串
+def write_streams(source_plan, results, csv_filename):
+    seen_links = linkset.LinkSet()
+    previous_links = linkset.LinkSet.load(link_fingerprints_filename)
+    total = kept = new_links = 0
+
+    # 按批把链接加入指纹集合并写出第一次出现的直播源
+    def flush(batch):
+        nonlocal total, kept, new_links
+        keep = seen_links.add([stream['link'] for stream in batch])
+        kept_streams = [stream for stream, first in zip(batch, keep) if first]
+        total += len(batch)
+        kept += len(kept_streams)
+        new_links += len(kept_streams) - int(sum(previous_links.contains([stream['link'] for stream in kept_streams])))
+        writer.writerows(kept_streams)
+
+    with open(csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        batch = []
+        for url, _ in source_plan:
+            for stream in results[url]:
+                batch.append(stream)
+                if len(batch) >= dedup_batch:
+                    flush(batch)
+                    batch = []
+        if batch:
+            flush(batch)
+
+    seen_links.save(link_fingerprints_filename)
+    print(f"去重：{total} 个链接，保留 {kept} 个，其中 {new_links} 个上次运行没有出现，"
+          f"指纹表 {seen_links.memory_bytes() // 1024} KB，哈希碰撞 {seen_links.collisions} 次")
+
+def main(profiler=None):
+    source_plan = plan_sources(m3u_urls, load_source_stats(source_stats_filename))
+    mirror_stats = load_source_stats(mirror_stats_filename)
+    with run_profiler.stage(profiler, 'fetch'):
+        results, epg_urls = fetch_playlists(source_plan, mirror_stats)
+    with open(mirror_stats_filename, 'w', encoding='utf-8') as f:
+        json.dump(mirror_stats, f, ensure_ascii=False, indent=1, sort_keys=True)
+    with run_profiler.stage(profiler, 'write'):
+        write_streams(source_plan, results, csv_filename)
+        write_epg_sources(source_plan, epg_urls, epg_sources_filename)
+    print(f"CSV文件 '{csv_filename}' 生成成功。")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true', help='输出性能分析结果（火焰图折叠栈和各阶段摘要）')
+    args = parser.parse_args()
+
+    if args.profile:
+        profiler = run_profiler.RunProfiler('main')
+        profiler.start()
+        main(profiler)
+        profiler.stop()
+        profiler.write()
+    else:
+        main()
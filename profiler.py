@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import asyncio
+import cProfile
+import pstats
+import io
+import threading
+from contextlib import contextmanager, nullcontext
+
+# main.py 和 live_streams.csv.py 共用的性能分析工具，只在 --profile 时启用
+# 输出两个文件：
+#   profile_<名称>.collapsed  采样得到的折叠调用栈，可直接交给 flamegraph.pl / speedscope 生成火焰图
+#   profile_<名称>.txt        每个阶段的耗时、采样热点和 cProfile 前N个函数，以及异步探测各阶段的耗时
+
+sample_interval = 0.005  # 采样间隔（秒）
+top_n = 20  # 摘要中每个阶段列出的函数数量
+
+class RunProfiler:
+    def __init__(self, name):
+        self.name = name
+        self.current_stage = 'startup'
+        self.stages = []  # [(阶段名, 耗时, cProfile统计文本)]
+        self.samples = {}  # 折叠调用栈 → 采样次数
+        self.stage_samples = {}  # 阶段 → {函数: 采样次数}
+        self.phases = {}  # 异步任务阶段 → [次数, 总耗时, 最大耗时]
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample_loop, name='profiler-sampler', daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+        self.total_time = time.perf_counter() - self.start_time
+
+    # 采样线程：定时抓取所有线程的调用栈，按当前阶段归类
+    def sample_loop(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(sample_interval):
+            stage = self.current_stage
+            counts = self.stage_samples.setdefault(stage, {})
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                counts[stack[0]] = counts.get(stack[0], 0) + 1
+                key = ';'.join([stage] + stack[::-1])
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    # 运行一个阶段，同时用cProfile记录主线程中的函数耗时
+    @contextmanager
+    def stage(self, name):
+        previous = self.current_stage
+        self.current_stage = name
+        profile = cProfile.Profile()
+        start = time.perf_counter()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.perf_counter() - start
+            self.current_stage = previous
+            output = io.StringIO()
+            pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(top_n)
+            self.stages.append((name, elapsed, output.getvalue()))
+
+    # 记录异步任务某个阶段的耗时，例如等待信号量、建立连接和收到响应头
+    def phase(self, name, seconds):
+        stats = self.phases.get(name)
+        if stats is None:
+            self.phases[name] = [1, seconds, seconds]
+        else:
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    # 测量事件循环的调度延迟，延迟大说明有回调阻塞了循环
+    async def watch_loop_lag(self, interval=0.1):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.phase('event loop lag', time.perf_counter() - start - interval)
+
+    def write(self):
+        collapsed_filename = f'profile_{self.name}.collapsed'
+        summary_filename = f'profile_{self.name}.txt'
+        with open(collapsed_filename, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f'{stack} {count}\n')
+
+        with open(summary_filename, 'w', encoding='utf-8') as f:
+            f.write(f'{self.name}: total {self.total_time:.3f} s\n\n')
+            for name, elapsed, _ in self.stages:
+                f.write(f'{name:<20} {elapsed:>10.3f} s\n')
+
+            if self.phases:
+                f.write(f'\n{"async phase":<24} {"count":>8} {"total s":>10} {"mean ms":>10} {"max ms":>10}\n')
+                for name, (count, total, longest) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+                    f.write(f'{name:<24} {count:>8} {total:>10.3f} {total / count * 1000:>10.2f} {longest * 1000:>10.2f}\n')
+
+            for name, elapsed, cprofile_text in self.stages:
+                f.write(f'\n===== {name} ({elapsed:.3f} s) =====\n')
+                counts = self.stage_samples.get(name, {})
+                total = sum(counts.values())
+                if total:
+                    f.write(f'sampled hot spots (all threads, {total} samples):\n')
+                    for function, count in sorted(counts.items(), key=lambda item: -item[1])[:top_n]:
+                        f.write(f'{count / total:>7.1%}  {function}\n')
+                f.write('\ncProfile (main thread):\n')
+                f.write(cprofile_text)
+
+        print(f"性能分析结果已写入 '{collapsed_filename}' 和 '{summary_filename}'")
+
+# 返回阶段计时上下文，未启用分析时为空操作
+def stage(profiler, name):
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
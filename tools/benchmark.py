@@ -0,0 +1,384 @@
+import argparse
+import csv
+import importlib.util
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 加载live_streams.csv.py（文件名带点，不能直接import）
+def load_validator():
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    spec = importlib.util.spec_from_file_location('live_streams_validator', os.path.join(repo_dir, 'live_streams.csv.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# 生成模拟的探测结果
+def synthetic_results(count, channels, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for i in range(count):
+        channel = f'CH{rng.randrange(channels):05d}'
+        available = rng.random() < 0.3
+        stream = {
+            'tvg-name': channel,
+            'tvg-id': channel,
+            'tvg-logo': f'https://live.fanmingming.com/tv/{channel}.png',
+            'group-title': '',
+            'link': f'http://host{rng.randrange(5000)}.example.com:8080/live/{i}/index.m3u8',
+            'source': f'https://github.com/example/src{i % 10}.m3u',
+            'speed': rng.uniform(0.05, 3.0),
+        }
+        results.append({'stream': stream, 'available': available, 'cost': stream['speed']})
+    return results
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    value = func(*args)
+    print(f"{label:<40} {time.perf_counter() - start:>8.3f} s")
+    return value
+
+# 对比csv.DictReader全量读取重写与SQLite索引增量合并
+def bench_index(args):
+    validator = load_validator()
+    results = synthetic_results(args.rows, args.channels)
+    fieldnames = ['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link', 'source', 'speed']
+    with open('valid_streams.csv', 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result['stream'])
+
+    # 下一次运行：10%的链接状态发生变化
+    rng = random.Random(1)
+    update = [dict(result, available=not result['available']) if rng.random() < 0.1 else result for result in results]
+    channels = [f'CH{i:05d}' for i in range(0, args.channels, max(1, args.channels // 1000))]
+
+    def csv_read():
+        with open('valid_streams.csv', 'r', newline='', encoding='utf-8') as csvfile:
+            return {(row['tvg-name'], row['link']): row for row in csv.DictReader(csvfile)}
+
+    def csv_merge(rows):
+        for result in update:
+            stream = result['stream']
+            rows[(stream['tvg-name'], stream['link'])] = stream
+        with open('valid_streams.csv', 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            for key in sorted(rows):
+                writer.writerow(rows[key])
+
+    def csv_lookup(rows):
+        by_channel = {}
+        for channel, link in rows:
+            by_channel.setdefault(channel, []).append(link)
+        return [by_channel.get(channel, []) for channel in channels]
+
+    def index_open():
+        conn = validator.open_link_index('link_index.sqlite', 'link_index.csv')
+        validator.merge_probe_results(conn, results)
+        return conn
+
+    def index_lookup(conn):
+        return [validator.lookup_channel(conn, channel) for channel in channels]
+
+    print(f"{args.rows} rows, {args.channels} channels, {len(channels)} channel lookups")
+    rows = timed('csv.DictReader read', csv_read)
+    timed('csv merge + full rewrite', csv_merge, rows)
+    timed('csv channel lookup (group first)', csv_lookup, rows)
+    conn = timed('index initial merge', index_open)
+    timed('index incremental merge', validator.merge_probe_results, conn, update)
+    timed('index channel lookup', index_lookup, conn)
+    timed('index deterministic export', validator.export_link_index, conn, 'link_index.csv')
+    conn.close()
+    os.remove('link_index.sqlite')
+    timed('index rebuild from export', lambda: validator.open_link_index('link_index.sqlite', 'link_index.csv').close())
+
+# 对比纯Python排序和NumPy向量化排序
+def bench_ranking(args):
+    validator = load_validator()
+    results = synthetic_results(args.rows, args.channels)
+    valid_streams = [result['stream'] for result in results]
+    with open('moban.txt', 'w', encoding='utf-8') as templatefile:
+        for i in range(args.channels):
+            templatefile.write(f'CH{i:05d}\n')
+    template = validator.compile_template('moban.txt', 'template_cache.json')
+
+    print(f"{args.rows} candidate rows, {args.channels} channels, weights {validator.ranking_weights}")
+    python_ranked = timed('python sort', validator.rank_streams, valid_streams, template, False)
+    if validator.np is None:
+        print('numpy is not installed')
+        return
+    numpy_ranked = timed('numpy lexsort', validator.rank_streams, valid_streams, template, True)
+
+    # 只计算向量化部分（不含组装字典列表）的耗时
+    np = validator.np
+    channel_ranks = np.asarray([template['rank'][stream['tvg-name']] for stream in valid_streams], dtype=np.int64)
+    metrics = {'speed': np.asarray([stream['speed'] for stream in valid_streams], dtype=np.float64)}
+    timed('numpy lexsort (arrays only)', validator.rank_order, channel_ranks, metrics)
+    same = [item[2]['link'] for item in python_ranked] == [item[2]['link'] for item in numpy_ranked]
+    print(f"same order: {same}")
+
+# 模拟一个月的每小时运行，统计最近失效过滤器节省的探测和误跳过的可用链接
+def bench_dead_filter(args):
+    validator = load_validator()
+    rng = random.Random(0)
+    validator.random.seed(0)
+    links = [f'http://host{i % 3000}.example.com/live/{i}.m3u8' for i in range(args.links)]
+    alive = [rng.random() >= args.dead_ratio for _ in links]
+    next_id = len(links)
+    start = 1700000000.0
+    dead_filter = validator.DeadLinkFilter(started=start)
+    baseline = probed = missed = live_total = 0
+
+    for run in range(args.days * 24):
+        now = start + run * 3600
+        dead_filter.rotate(now)
+        # 链接状态变化：部分可用链接失效、少量失效链接恢复、部分旧链接被新链接替换
+        for i in range(len(links)):
+            if rng.random() < (args.churn if alive[i] else args.churn / 5):
+                alive[i] = not alive[i]
+            if rng.random() < args.churn / 2:
+                links[i] = f'http://host{next_id % 3000}.example.com/live/{next_id}.m3u8'
+                alive[i] = rng.random() >= args.dead_ratio
+                next_id += 1
+        streams = [{'link': link, 'alive': state} for link, state in zip(links, alive)]
+        to_probe, _, skipped = validator.filter_known_dead(streams, dead_filter)
+        baseline += len(streams)
+        probed += len(to_probe)
+        live_total += sum(alive)
+        missed += sum(1 for stream in skipped if stream['alive'])
+        for stream in to_probe:
+            if not stream['alive']:
+                dead_filter.add(stream['link'])
+
+    runs = args.days * 24
+    print(f"{runs} hourly runs, {args.links} links per run, {args.dead_ratio:.0%} dead, {args.churn:.1%} churn per hour")
+    print(f"filter memory            {dead_filter.memory_bytes() / 1024:.0f} KB ({len(dead_filter.generations)} generations)")
+    print(f"current generation fill  {dead_filter.fill_ratio():.2%}")
+    print(f"probes without filter    {baseline}")
+    print(f"probes with filter       {probed} ({1 - probed / baseline:.1%} avoided)")
+    print(f"live links skipped       {missed} ({missed / live_total:.2%} of live link-runs)")
+
+# 测量探测结果检查点的开销：记录、批量写入和fsync
+def bench_checkpoint(args):
+    validator = load_validator()
+    results = synthetic_results(args.probes, 5000)
+    syncs = 0
+    sync = validator.ProbeCheckpoint.sync
+
+    def counting_sync(checkpoint):
+        nonlocal syncs
+        syncs += 1
+        sync(checkpoint)
+
+    validator.ProbeCheckpoint.sync = counting_sync
+    start = time.perf_counter()
+    checkpoint = validator.ProbeCheckpoint('probe_checkpoint.jsonl')
+    for result in results:
+        checkpoint.record(result)
+    checkpoint.close()
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize('probe_checkpoint.jsonl')
+
+    start = time.perf_counter()
+    resumed = validator.ProbeCheckpoint('probe_checkpoint.jsonl', resume=True)
+    restored, pending = resumed.split([result['stream'] for result in results])
+    resumed.close()
+    resume_elapsed = time.perf_counter() - start
+
+    print(f"{args.probes} probes, batch {validator.checkpoint_batch}, interval {validator.checkpoint_interval} s")
+    print(f"checkpoint write total   {elapsed:.3f} s ({elapsed / args.probes * 1e6:.1f} us per probe, {syncs} fsyncs)")
+    print(f"checkpoint size          {size / 1024:.0f} KB")
+    print(f"resume load + split      {resume_elapsed:.3f} s ({len(restored)} restored, {len(pending)} pending)")
+
+# 模拟连续运行：每个直播源有固定的真实延迟，每次测量带有长尾噪声
+# 对比单次测量和多次采样（中位数、p90、抖动）排序时，相邻两次运行的首选直播源是否变化
+def bench_stability(args):
+    validator = load_validator()
+    rng = random.Random(0)
+    with open('moban.txt', 'w', encoding='utf-8') as templatefile:
+        for i in range(args.channels):
+            templatefile.write(f'CH{i:05d}\n')
+    template = validator.compile_template('moban.txt', 'template_cache.json')
+    streams = []
+    for channel in range(args.channels):
+        for i in range(args.per_channel):
+            streams.append({'tvg-name': f'CH{channel:05d}', 'group-title': '', 'link': f'http://host{rng.randrange(2000)}.example.com/{channel}/{i}',
+                            'true_latency': rng.uniform(0.05, 0.6), 'noise': rng.uniform(0.0, 0.5)})
+
+    def measure(stream):
+        # 大多数测量接近真实延迟，偶尔遇到排队或丢包出现长尾
+        value = stream['true_latency'] * rng.uniform(0.8, 1.3)
+        if rng.random() < stream['noise'] * 0.3:
+            value += rng.expovariate(1 / 0.8)
+        return value
+
+    def run(samples):
+        current = []
+        for stream in streams:
+            stream = dict(stream)
+            if samples:
+                stream.update(validator.latency_stats([measure(stream) for _ in range(samples)]))
+            else:
+                stream['speed'] = measure(stream)
+            current.append(stream)
+        ranked = validator.rank_streams(current, template)
+        return {stream['tvg-name']: stream for _, position, stream in ranked if position == 0}
+
+    print(f"{args.channels} channels x {args.per_channel} streams, {args.runs} consecutive runs")
+    for label, samples, weights in (('single sample', 0, {'speed': 1.0}), (f'{args.samples} samples', args.samples, validator.sampled_ranking_weights)):
+        validator.ranking_weights = weights
+        previous = run(samples)
+        same = total = 0
+        regret = []
+        for _ in range(args.runs - 1):
+            current = run(samples)
+            same += sum(1 for channel, stream in current.items() if previous[channel]['link'] == stream['link'])
+            total += len(current)
+            best = {}
+            for stream in streams:
+                best[stream['tvg-name']] = min(best.get(stream['tvg-name'], 9.0), stream['true_latency'])
+            regret += [stream['true_latency'] - best[channel] for channel, stream in current.items()]
+            previous = current
+        print(f"{label:<16} top choice unchanged {same / total:.1%}, mean regret vs true best {sum(regret) / len(regret) * 1000:.0f} ms")
+
+# 生成一批模拟链接：部分是200多个字符的带签名链接，约20%与之前的链接重复
+def synthetic_links(start, count, rng):
+    links = []
+    for i in range(start, start + count):
+        n = rng.randrange(i) if i and rng.random() < 0.2 else i
+        if n % 3 == 0:
+            links.append(f'https://cdn{n % 997}.example.com/live/{n}/index.m3u8?auth_key=1692536679-0-0-{n:032x}&sign={n * 2654435761 % (1 << 64):064x}')
+        else:
+            links.append(f'http://host{n % 5000}.example.com:8080/live/{n}/index.m3u8')
+    return links
+
+# 对比Python字符串集合与定长指纹集合的内存和插入速度
+def bench_linkset(args):
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    import linkset
+    rng = random.Random(0)
+    batch = 1000000
+
+    # 字符串集合只测到baseline_max，更大的规模按每条的字节数推算
+    seen = set()
+    string_bytes = 0
+    start = time.perf_counter()
+    for offset in range(0, args.baseline_max, batch):
+        for link in synthetic_links(offset, min(batch, args.baseline_max - offset), rng):
+            if link not in seen:
+                seen.add(link)
+                string_bytes += sys.getsizeof(link)
+    elapsed = time.perf_counter() - start
+    per_link = (sys.getsizeof(seen) + string_bytes) / len(seen)
+    print(f"set of str       {args.baseline_max:>10} links  {elapsed:>7.1f} s  {args.baseline_max / elapsed / 1e6:.2f} M/s  "
+          f"{per_link:.0f} B/link, {per_link * args.links / (1 << 20):.0f} MB extrapolated to {args.links}")
+    del seen
+
+    for bits in (64, 128):
+        rng = random.Random(0)
+        links_set = linkset.LinkSet(bits)
+        kept = 0
+        insert_time = 0.0
+        for offset in range(0, args.links, batch):
+            links = synthetic_links(offset, min(batch, args.links - offset), rng)
+            start = time.perf_counter()
+            kept += int(sum(links_set.add(links)))
+            insert_time += time.perf_counter() - start
+        start = time.perf_counter()
+        found = int(sum(links_set.contains(links)))
+        lookup_time = time.perf_counter() - start
+        with tempfile.TemporaryDirectory() as workdir:
+            filename = os.path.join(workdir, 'link_fingerprints.npy')
+            links_set.save(filename)
+            start = time.perf_counter()
+            linkset.LinkSet.load(filename, bits)
+            load_time = time.perf_counter() - start
+        print(f"LinkSet {bits:>3}-bit {args.links:>10} links  {insert_time:>7.1f} s  {args.links / insert_time / 1e6:.2f} M/s  "
+              f"{links_set.memory_bytes() / len(links_set):.0f} B/link, {links_set.memory_bytes() / (1 << 20):.0f} MB, "
+              f"{kept} kept, {links_set.collisions} collisions, lookup {len(links) / lookup_time / 1e6:.2f} M/s ({found} found), "
+              f"load {load_time:.2f} s")
+
+# main.write_streams按批去重写出：测量结果之外的峰值内存（不含已下载的直播源本身）
+def bench_write_streams(args):
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    import main
+    rng = random.Random(0)
+    per_source = args.links // args.sources
+    source_plan = [(f'https://example.com/source{i}.m3u', None) for i in range(args.sources)]
+    results = {}
+    for index, (url, _) in enumerate(source_plan):
+        results[url] = [{'tvg-name': 'CCTV1', 'tvg-id': 'CCTV1', 'tvg-logo': '', 'group-title': '', 'link': link, 'source': url}
+                        for link in synthetic_links(index * per_source, per_source, rng)]
+    start = time.perf_counter()
+    main.write_streams(source_plan, results, 'live_streams.csv')
+    elapsed = time.perf_counter() - start
+
+    # tracemalloc会明显拖慢运行，峰值内存单独再测一次
+    os.remove(main.link_fingerprints_filename)
+    tracemalloc.start()
+    main.write_streams(source_plan, results, 'live_streams.csv')
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"write_streams {args.links} links in batches of {main.dedup_batch}: {elapsed:.1f} s, "
+          f"peak {peak / (1 << 20):.0f} MB on top of the downloaded streams")
+
+def main():
+    parser = argparse.ArgumentParser(description='iptv4 benchmarks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparsers.add_parser('index', help='SQLite link index vs csv.DictReader')
+    index_parser.add_argument('--rows', type=int, default=200000)
+    index_parser.add_argument('--channels', type=int, default=5000)
+    index_parser.set_defaults(func=bench_index)
+
+    ranking_parser = subparsers.add_parser('ranking', help='python sort vs numpy vectorized ranking')
+    ranking_parser.add_argument('--rows', type=int, default=1000000)
+    ranking_parser.add_argument('--channels', type=int, default=5000)
+    ranking_parser.set_defaults(func=bench_ranking)
+
+    dead_filter_parser = subparsers.add_parser('deadfilter', help='simulated month of hourly runs with the dead link filter')
+    dead_filter_parser.add_argument('--days', type=int, default=30)
+    dead_filter_parser.add_argument('--links', type=int, default=12000)
+    dead_filter_parser.add_argument('--dead-ratio', type=float, default=0.75)
+    dead_filter_parser.add_argument('--churn', type=float, default=0.005)
+    dead_filter_parser.set_defaults(func=bench_dead_filter)
+
+    checkpoint_parser = subparsers.add_parser('checkpoint', help='probe checkpoint overhead')
+    checkpoint_parser.add_argument('--probes', type=int, default=50000)
+    checkpoint_parser.set_defaults(func=bench_checkpoint)
+
+    stability_parser = subparsers.add_parser('stability', help='ranking stability with single vs repeated latency samples')
+    stability_parser.add_argument('--channels', type=int, default=500)
+    stability_parser.add_argument('--per-channel', type=int, default=8)
+    stability_parser.add_argument('--samples', type=int, default=5)
+    stability_parser.add_argument('--runs', type=int, default=6)
+    stability_parser.set_defaults(func=bench_stability)
+
+    linkset_parser = subparsers.add_parser('linkset', help='fingerprint link set vs python set of strings')
+    linkset_parser.add_argument('--links', type=int, default=20000000)
+    linkset_parser.add_argument('--baseline-max', type=int, default=2000000)
+    linkset_parser.set_defaults(func=bench_linkset)
+
+    write_streams_parser = subparsers.add_parser('writestreams', help='peak memory of batched dedup in main.write_streams')
+    write_streams_parser.add_argument('--links', type=int, default=2000000)
+    write_streams_parser.add_argument('--sources', type=int, default=40)
+    write_streams_parser.set_defaults(func=bench_write_streams)
+
+    args = parser.parse_args()
+    # 在临时目录中运行，避免覆盖仓库中的文件
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
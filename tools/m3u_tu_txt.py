@@ -1,31 +1,133 @@
 import os
+import mmap
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+write_buffer_size = 1 << 20  # 输出缓冲区大小，攒够1MB再写入文件
+
+# 从#EXTINF行中取出频道名，优先使用tvg-name，没有则使用逗号后的显示名称
+def extinf_name(line):
+    start = line.find(b'tvg-name="')
+    if start >= 0:
+        start += len(b'tvg-name="')
+        end = line.find(b'"', start)
+        if end > start:
+            return line[start:end].strip()
+
+    # 属性值中可能含有逗号，从最后一个引号之后开始找
+    comma = line.find(b',', line.rfind(b'"') + 1)
+    if comma < 0:
+        return b''
+    return line[comma + 1:].strip()
+
+# 逐条扫描m3u内容，不生成行列表，返回(频道名, 链接)
+def iter_entries(data):
+    size = len(data)
+    pos = data.find(b'#EXTINF')
+    while 0 <= pos < size:
+        eol = data.find(b'\n', pos)
+        if eol < 0:
+            eol = size
+        name = extinf_name(data[pos:eol].rstrip(b'\r'))
+
+        # 跳过#EXTVLCOPT等注释行和空行，找到下一条链接
+        pos = eol + 1
+        url = None
+        while pos < size:
+            eol = data.find(b'\n', pos)
+            if eol < 0:
+                eol = size
+            line = data[pos:eol].strip()
+            if line.startswith(b'#EXTINF'):
+                break
+            pos = eol + 1
+            if line and not line.startswith(b'#'):
+                url = line
+                break
+
+        if url is not None:
+            yield name, url
+        pos = data.find(b'#EXTINF', pos)
 
 def parse_m3u(m3u_file):
     txt_file = os.path.splitext(m3u_file)[0] + ".txt"
-    
-    with open(m3u_file, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-
-    channels = []
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-        if line.startswith('#EXTINF:-1'):
-            info = line.split('tvg-name="')[1].split('"')[0]
-            url = lines[i + 1].strip()
-            channels.append((info, url))
-            i += 1
-        i += 1
-
-    with open(txt_file, 'w', encoding='utf-8') as f:
-        for channel in channels:
-            f.write(f"{channel[0]},{channel[1]}\n")
-
-def convert_all_m3u_files():
-    current_directory = os.getcwd()
-    for file in os.listdir(current_directory):
+    size = os.path.getsize(m3u_file)
+
+    with open(m3u_file, 'rb') as f, open(txt_file, 'wb', buffering=write_buffer_size) as out:
+        if size == 0:
+            return size
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            chunk = []
+            chunk_size = 0
+            for name, url in iter_entries(data):
+                line = name + b',' + url + b'\n'
+                chunk.append(line)
+                chunk_size += len(line)
+                if chunk_size >= write_buffer_size:
+                    out.write(b''.join(chunk))
+                    chunk = []
+                    chunk_size = 0
+            out.write(b''.join(chunk))
+    return size
+
+# 使用进程池并行转换多个文件，返回总字节数和耗时
+def convert_files(m3u_files, workers=None):
+    start = time.perf_counter()
+    if len(m3u_files) <= 1 or workers == 1:
+        total = sum(parse_m3u(m3u_file) for m3u_file in m3u_files)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            total = sum(executor.map(parse_m3u, m3u_files))
+    return total, time.perf_counter() - start
+
+def report_throughput(label, file_count, total, elapsed):
+    mb = total / (1 << 20)
+    print(f"{label}: {file_count} files, {mb:.1f} MB in {elapsed:.2f} s, {mb / elapsed if elapsed else 0:.1f} MB/s")
+
+def convert_all_m3u_files(directory=None, workers=None):
+    directory = directory or os.getcwd()
+    m3u_files = [os.path.join(directory, file) for file in sorted(os.listdir(directory)) if file.endswith(".m3u")]
+    total, elapsed = convert_files(m3u_files, workers)
+    report_throughput(directory, len(m3u_files), total, elapsed)
+
+# 用目录中的m3u文件拼出指定大小的模拟语料，测试大批量转换的吞吐量
+def synthetic_benchmark(directory, size_mb, workers=None, file_mb=64):
+    samples = []
+    for file in sorted(os.listdir(directory)):
         if file.endswith(".m3u"):
-            parse_m3u(os.path.join(current_directory, file))
+            with open(os.path.join(directory, file), 'rb') as f:
+                samples.append(f.read())
+    sample = b''.join(samples) or b'#EXTM3U\n#EXTINF:-1 ,Test\nhttp://example.com/test.m3u8\n'
+
+    workdir = tempfile.mkdtemp()
+    try:
+        m3u_files = []
+        remaining = size_mb << 20
+        while remaining > 0:
+            path = os.path.join(workdir, f'synthetic_{len(m3u_files):04d}.m3u')
+            target = min(remaining, file_mb << 20)
+            with open(path, 'wb') as f:
+                written = 0
+                while written < target:
+                    f.write(sample)
+                    written += len(sample)
+            remaining -= written
+            m3u_files.append(path)
+        total, elapsed = convert_files(m3u_files, workers)
+        report_throughput(f'synthetic {size_mb} MB', len(m3u_files), total, elapsed)
+    finally:
+        shutil.rmtree(workdir)
 
 if __name__ == "__main__":
-    convert_all_m3u_files()
+    parser = argparse.ArgumentParser(description='将目录中的m3u文件批量转换为txt')
+    parser.add_argument('directory', nargs='?', default=None)
+    parser.add_argument('--workers', type=int, default=None, help='进程数，默认为CPU核数')
+    parser.add_argument('--synthetic-mb', type=int, default=0, help='额外生成指定大小的模拟语料测试吞吐量')
+    args = parser.parse_args()
+
+    convert_all_m3u_files(args.directory, args.workers)
+    if args.synthetic_mb:
+        synthetic_benchmark(args.directory or os.getcwd(), args.synthetic_mb, args.workers)
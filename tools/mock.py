@@ -0,0 +1,372 @@
+import argparse
+import asyncio
+import csv
+import importlib
+import importlib.util
+import json
+import os
+import random
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 加载live_streams.csv.py（文件名带点，不能直接import）
+def load_validator():
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    spec = importlib.util.spec_from_file_location('live_streams_validator', os.path.join(repo_dir, 'live_streams.csv.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# 本地模拟环境：用回环地址上的小服务器复现各个探测和下载功能，不访问外网
+# 每个子命令在临时目录中运行，输出与正式运行相同的报告
+
+# 生成一个有count个直播源的m3u播放列表
+def sample_playlist(count):
+    lines = ['#EXTM3U']
+    for i in range(count):
+        lines.append(f'#EXTINF:-1 tvg-id="CCTV{i % 17 + 1}" tvg-name="CCTV{i % 17 + 1}" tvg-logo="" group-title="央视",CCTV{i % 17 + 1}')
+        lines.append(f'http://example.com/live/{i}.m3u8')
+    return '\n'.join(lines) + '\n'
+
+class ThreadingHTTPServerV6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+# 在后台线程中运行HTTP服务器，返回(服务器, 端口)
+def start_http_server(handler, host='127.0.0.1', port=0):
+    server = (ThreadingHTTPServerV6 if ':' in host else ThreadingHTTPServer)((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+# 写入live_streams.csv，每项为(频道名, 链接)
+def write_live_streams(filename, streams):
+    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['tvg-name', 'tvg-id', 'tvg-logo', 'group-title', 'link'])
+        for name, link in streams:
+            writer.writerow([name, name, f'https://live.fanmingming.com/tv/{name}.png', '', link])
+
+# 用仓库中的模板对当前目录的live_streams.csv做一次完整验证，返回用时
+async def run_validator(validator, **options):
+    shutil.copy(os.path.join(repo_dir, validator.template_filename), validator.template_filename)
+    start = time.perf_counter()
+    await validator.validate_and_generate_files(validator.csv_filename, validator.output_m3u_filename, validator.output_txt_filename,
+                                                validator.output_csv_filename, validator.template_filename, **options)
+    return time.perf_counter() - start
+
+# 打印有效直播源的频道名和链接
+def print_valid_streams(filename):
+    with open(filename, 'r', newline='', encoding='utf-8') as csvfile:
+        for row in csv.DictReader(csvfile):
+            print(f"  {row['tvg-name']:<8} {row['link']}")
+
+# 镜像竞速：几个本地镜像分别有不同的延迟，或者返回错误状态、错误页面、在响应体中途停止发送，多轮竞速后观察胜出者和镜像排序
+def mock_mirrors(args):
+    if repo_dir not in sys.path:
+        sys.path.insert(0, repo_dir)
+    main = importlib.import_module('main')
+    behaviours = args.mirrors.split(',')
+    playlist = sample_playlist(args.streams).encode('utf-8')
+
+    class MirrorHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            index = int(self.path.split('/')[1][1:])
+            behaviour = behaviours[index]
+            if behaviour == 'error':
+                self.send_response(500)
+                self.end_headers()
+                return
+            if behaviour == 'stall':
+                # 发出响应头和一半内容后不再发送，读超时发生在读取响应体的过程中
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(playlist)))
+                self.end_headers()
+                self.wfile.write(playlist[:len(playlist) // 2])
+                self.wfile.flush()
+                time.sleep(main.mirror_timeout + 5)
+                return
+            if behaviour == 'html':
+                body = b'<html><body>rate limited</body></html>'
+            else:
+                time.sleep(float(behaviour))
+                body = playlist
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    main.mirror_timeout = args.timeout
+    server, port = start_http_server(MirrorHandler)
+    main.mirror_templates = [f'http://127.0.0.1:{port}/m{index}/{{owner}}/{{repo}}/{{ref}}/{{path}}' for index in range(len(behaviours))]
+    m3u_url = 'https://github.com/qjlxg/iptv4/raw/master/avto-full.m3u'
+    mirror_stats = {}
+    try:
+        for race in range(args.rounds):
+            order = [template.split('/')[3] for template, _ in main.mirror_urls(m3u_url, mirror_stats)]
+            start = time.perf_counter()
+            result = main.race_mirrors(m3u_url, None, mirror_stats)
+            streams = len(result['streams']) if result else 0
+            print(f"round {race + 1}: start order {' '.join(order)}, {streams} streams in {time.perf_counter() - start:.2f} s")
+    finally:
+        server.shutdown()
+    for template, stats in sorted(mirror_stats.items()):
+        print(f"  {template.split('/')[3]} ({behaviours[int(template.split('/')[3][1:])]}): {stats}")
+
+# RTSP服务器：OPTIONS总是成功，DESCRIBE只对路径以/live结尾的地址返回SDP，其余返回404
+async def rtsp_handler(reader, writer):
+    try:
+        while True:
+            request = (await reader.readuntil(b'\r\n\r\n')).decode()
+            lines = request.split('\r\n')
+            method, url, _ = lines[0].split(' ')
+            cseq = next(line.split(':', 1)[1].strip() for line in lines if line.lower().startswith('cseq'))
+            if method == 'OPTIONS':
+                writer.write(f'RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\nPublic: OPTIONS, DESCRIBE, SETUP, PLAY\r\n\r\n'.encode())
+            elif url.endswith('/live'):
+                sdp = b'v=0\r\no=- 0 0 IN IP4 127.0.0.1\r\ns=mock\r\nm=video 0 RTP/AVP 96\r\n'
+                writer.write(f'RTSP/1.0 200 OK\r\nCSeq: {cseq}\r\nContent-Type: application/sdp\r\nContent-Length: {len(sdp)}\r\n\r\n'.encode() + sdp)
+            else:
+                writer.write(f'RTSP/1.0 404 Not Found\r\nCSeq: {cseq}\r\n\r\n'.encode())
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    writer.close()
+
+def amf_string(value):
+    data = value.encode()
+    return b'\x02' + struct.pack('>H', len(data)) + data
+
+# RTMP服务器：完成握手，读取connect命令，应用名为live时回复_result，否则回复_error
+async def rtmp_handler(reader, writer):
+    try:
+        c0c1 = await reader.readexactly(1537)
+        writer.write(b'\x03' + bytes(1536) + c0c1[1:])
+        await writer.drain()
+        await reader.readexactly(1536)
+        header = await reader.readexactly(12)
+        length = int.from_bytes(header[4:7], 'big')
+        body = b''
+        while len(body) < length:
+            if body:
+                await reader.readexactly(1)  # 128字节一块，后续块的1字节块头
+            body += await reader.readexactly(min(128, length - len(body)))
+        offset = body.index(b'app') + 4
+        app = body[offset + 2:offset + 2 + struct.unpack('>H', body[offset:offset + 2])[0]].decode()
+
+        def message(type_id, payload, chunk_stream=2):
+            return bytes([chunk_stream]) + bytes(3) + len(payload).to_bytes(3, 'big') + bytes([type_id]) + bytes(4) + payload
+
+        writer.write(message(5, struct.pack('>I', 2500000)) + message(1, struct.pack('>I', 4096)))
+        payload = (amf_string('_result' if app == 'live' else '_error') + b'\x00' + struct.pack('>d', 1) +
+                   b'\x03\x00\x04code' + amf_string('NetConnection.Connect.Success') + b'\x00\x00\x09')
+        writer.write(message(20, payload, 3))
+        await writer.drain()
+        await asyncio.sleep(1)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    writer.close()
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# 向一个UDP端口持续发送RTP封装的TS包，模拟组播源
+async def udp_sender(port, stop):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        packet = b'\x80\x21' + bytes(10) + (b'\x47' + bytes(187)) * 7
+        while not stop.is_set():
+            sock.sendto(packet, ('127.0.0.1', port))
+            await asyncio.sleep(0.05)
+
+# 返回m3u8播放列表的HTTP处理函数，/ok/开头的路径返回播放列表，其余返回404
+def playlist_handler():
+    class PlaylistHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if not self.path.startswith('/ok/'):
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = b'#EXTM3U\n#EXT-X-TARGETDURATION:1\n#EXT-X-MEDIA-SEQUENCE:1\nseg1.ts\n'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return PlaylistHandler
+
+# 非HTTP协议：本地的RTSP、RTMP服务器和UDP发送端，每种协议一个可用、一个不可用的直播源
+def mock_protocols(args):
+    validator = load_validator()
+    validator.protocol_timeout = args.timeout
+
+    async def run():
+        rtsp = await asyncio.start_server(rtsp_handler, '127.0.0.1', 0)
+        rtmp = await asyncio.start_server(rtmp_handler, '127.0.0.1', 0)
+        rtsp_port = rtsp.sockets[0].getsockname()[1]
+        rtmp_port = rtmp.sockets[0].getsockname()[1]
+        http, http_port = start_http_server(playlist_handler())
+        udp_port, silent_udp_port = free_port(socket.SOCK_DGRAM), free_port(socket.SOCK_DGRAM)
+        stop = asyncio.Event()
+        sender = asyncio.ensure_future(udp_sender(udp_port, stop))
+        write_live_streams(validator.csv_filename, [
+            ('CCTV1', f'rtsp://127.0.0.1:{rtsp_port}/live'),
+            ('CCTV1', f'rtsp://127.0.0.1:{rtsp_port}/missing'),
+            ('CCTV6', f'rtmp://127.0.0.1:{rtmp_port}/live/stream1'),
+            ('CCTV6', f'rtmp://127.0.0.1:{rtmp_port}/closed/stream1'),
+            ('CCTV9', f'udp://@127.0.0.1:{udp_port}'),
+            ('CCTV9', f'udp://@127.0.0.1:{silent_udp_port}'),
+            ('CCTV13', f'rtsp://127.0.0.1:{http_port}/ok/1'),  # HTTP服务器上的rtsp链接，握手失败
+            ('CCTV13', f'http://127.0.0.1:{http_port}/ok/1'),
+        ])
+        try:
+            elapsed = await run_validator(validator, prescreen=args.prescreen)
+        finally:
+            stop.set()
+            await sender
+            rtsp.close()
+            rtmp.close()
+            http.shutdown()
+        print(f"验证用时 {elapsed:.1f} 秒，有效直播源：")
+        print_valid_streams(validator.output_csv_filename)
+
+    asyncio.run(run())
+
+# 双栈：回环地址上一个IPv4/IPv6都可用、一个只有IPv6、一个只有IPv4的主机，
+# 三个主机名在DNS缓存中都解析到::1和127.0.0.1，观察竞速结果和iptv4/iptv6两个列表
+def mock_dualstack(args):
+    validator = load_validator()
+    handler = playlist_handler()
+    servers = []
+    dual, dual_port = start_http_server(handler, '127.0.0.1')
+    servers += [dual, start_http_server(handler, '::1', dual_port)[0]]
+    v6_only, v6_port = start_http_server(handler, '::1')
+    v4_only, v4_port = start_http_server(handler, '127.0.0.1')
+    servers += [v6_only, v4_only]
+
+    expires = time.time() + 3600
+    addrs = [[socket.AF_INET6, '::1'], [socket.AF_INET, '127.0.0.1']]
+    with open(validator.host_cache_filename, 'w', encoding='utf-8') as f:
+        json.dump({'dns': {host: {'addrs': addrs, 'expires': expires} for host in ('dual.test', 'v6only.test', 'v4only.test')}}, f)
+    write_live_streams(validator.csv_filename, [
+        ('CCTV1', f'http://dual.test:{dual_port}/ok/1'),
+        ('CCTV6', f'http://v6only.test:{v6_port}/ok/1'),
+        ('CCTV9', f'http://v4only.test:{v4_port}/ok/1'),
+        ('CCTV13', f'http://[::1]:{v6_port}/ok/2'),
+        ('CCTV13', f'http://127.0.0.1:{v4_port}/ok/2'),
+    ])
+    try:
+        elapsed = asyncio.run(run_validator(validator, dual_stack=True, publish_partial=args.publish_partial))
+    finally:
+        for server in servers:
+            server.shutdown()
+    print(f"验证用时 {elapsed:.1f} 秒")
+    for filename in (validator.output_csv_filename, f'valid_streams_{validator.ipv6_output_prefix}.csv'):
+        print(f"{filename}：")
+        print_valid_streams(filename)
+
+# 返回一个积压队列已满的监听端口：新的连接请求被丢弃，只能等到连接超时，模拟被丢包的主机
+def blackhole_port(sockets):
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    sockets += [listener, socket.create_connection(('127.0.0.1', port))]
+    return port
+
+# TCP预筛：可用链接、404、拒绝连接的端口、丢包的端口和无法解析的主机混在一起，
+# 分别在不预筛和预筛两种模式下完整验证一次，比较用时和有效直播源数量
+def mock_prescreen(args):
+    handler = playlist_handler()
+    server, port = start_http_server(handler)
+    sockets = []
+    links = [f'http://127.0.0.1:{port}/ok/{i}' for i in range(args.working)]
+    links += [f'http://127.0.0.1:{port}/nf/{i}' for i in range(args.not_found)]
+    for _ in range(args.refused):
+        refused = free_port()
+        links += [f'http://127.0.0.1:{refused}/live/{i}.m3u8' for i in range(args.links_per_host)]
+    for _ in range(args.blackholed):
+        blackholed = blackhole_port(sockets)
+        links += [f'http://127.0.0.1:{blackholed}/live/{i}.m3u8' for i in range(args.links_per_host)]
+    links += [f'http://nohost{i}.invalid/live.m3u8' for i in range(args.unresolved)]
+    random.Random(1).shuffle(links)
+
+    with open(os.path.join(repo_dir, 'moban.txt'), 'r', encoding='utf-8') as f:
+        names = [line.strip() for line in f if line.strip() and ',' not in line][:50]
+    workdir = os.getcwd()
+    try:
+        for prescreen in (False, True):
+            # 每种模式在单独的目录中运行，避免共用DNS缓存、主机熔断和失效链接过滤器
+            os.chdir(workdir)
+            rundir = 'prescreen' if prescreen else 'direct'
+            os.mkdir(rundir)
+            os.chdir(rundir)
+            validator = load_validator()
+            validator.tier_concurrency = [args.concurrency, args.concurrency]
+            validator.default_concurrency = args.concurrency
+            validator.host_failure_threshold = 10 ** 6  # 关闭主机熔断，只比较预筛的效果
+            write_live_streams(validator.csv_filename, [(names[i % len(names)], link) for i, link in enumerate(links)])
+            elapsed = asyncio.run(run_validator(validator, prescreen=prescreen))
+            with open(validator.output_csv_filename, 'r', encoding='utf-8') as f:
+                valid = sum(1 for _ in f) - 1
+            print(f"{'预筛' if prescreen else '不预筛'}：{len(links)} 个链接，有效 {valid} 个，用时 {elapsed:.1f} 秒")
+    finally:
+        os.chdir(workdir)
+        server.shutdown()
+        for sock in sockets:
+            sock.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='iptv4 local mocks')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    mirrors_parser = subparsers.add_parser('mirrors', help='race local stand-in mirrors with different delays')
+    mirrors_parser.add_argument('--mirrors', default='stall,error,html,1.5,0.2',
+                                help='comma separated mirror behaviours: delay in seconds, error (HTTP 500), html (error page) '
+                                     'or stall (stops halfway through the body)')
+    mirrors_parser.add_argument('--timeout', type=float, default=2, help='mirror timeout in seconds')
+    mirrors_parser.add_argument('--streams', type=int, default=2000)
+    mirrors_parser.add_argument('--rounds', type=int, default=3)
+    mirrors_parser.set_defaults(func=mock_mirrors)
+
+    protocols_parser = subparsers.add_parser('protocols', help='probe local RTSP, RTMP and UDP stand-ins next to HTTP')
+    protocols_parser.add_argument('--timeout', type=float, default=2, help='protocol probe timeout in seconds')
+    protocols_parser.add_argument('--prescreen', action='store_true', help='run the TCP prescreen first')
+    protocols_parser.set_defaults(func=mock_protocols)
+
+    dualstack_parser = subparsers.add_parser('dualstack', help='race IPv4 and IPv6 on loopback hosts with one or both families')
+    dualstack_parser.add_argument('--publish-partial', action='store_true', help='also write the early partial files')
+    dualstack_parser.set_defaults(func=mock_dualstack)
+
+    prescreen_parser = subparsers.add_parser('prescreen', help='compare a full run with and without --prescreen on a realistic failure mix')
+    prescreen_parser.add_argument('--working', type=int, default=40)
+    prescreen_parser.add_argument('--not-found', type=int, default=20)
+    prescreen_parser.add_argument('--refused', type=int, default=10, help='hosts with a closed port')
+    prescreen_parser.add_argument('--blackholed', type=int, default=5, help='hosts whose listen backlog is full')
+    prescreen_parser.add_argument('--unresolved', type=int, default=6, help='.invalid hosts')
+    prescreen_parser.add_argument('--links-per-host', type=int, default=5)
+    prescreen_parser.add_argument('--concurrency', type=int, default=20)
+    prescreen_parser.set_defaults(func=mock_prescreen)
+
+    args = parser.parse_args()
+    # 在临时目录中运行，避免覆盖仓库中的文件
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())